@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import pymongo
+from google.cloud import bigquery
+from bson.objectid import ObjectId
+from bson import json_util
+import pyarrow.parquet as pq
+import os
+import json
+import threading
+import traceback
+from dotenv import load_dotenv
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flatten_weather_data import flatten_documents
+from bigquery_writer import get_daily_summary_statement
+
+# Set up credentials
+load_dotenv()
+dataset_id = os.getenv("BIGQUERY_DATASET_ID")
+weather_table_id = os.getenv("BIGQUERY_WEATHER_TABLE_ID")
+places_table_id = os.getenv("BIGQUERY_PLACES_TABLE_ID")
+daily_table_id = os.getenv("BIGQUERY_DAILY_TABLE_ID", f"{weather_table_id}_daily")
+maintain_daily_summary = os.getenv("MAINTAIN_DAILY_SUMMARY", "true").lower() == "true"
+key_file_name = os.getenv("GCP_SERVICE_ACCOUNT_KEY_FILE_NAME")
+script_dir = os.path.dirname(os.path.abspath(__file__))
+file_path = os.path.join(script_dir, f"../data/{key_file_name}")
+os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = file_path
+
+# Set up the backfill
+output_dir = os.getenv("BACKFILL_OUTPUT_DIR", os.path.join(script_dir, "../data/backfill"))
+checkpoint_file_path = os.path.join(output_dir, "checkpoint.json")
+# Documents which cannot be converted to rows are set aside here, so the rest of their file is still written
+dead_letter_file_path = os.getenv("BACKFILL_DEAD_LETTER_FILE", os.path.join(output_dir, "dead_letters.jsonl"))
+dead_letter_lock = threading.Lock()
+partition_count = int(os.getenv("BACKFILL_PARTITIONS", 8))
+worker_count = int(os.getenv("BACKFILL_WORKERS", 4))
+cursor_batch_size = int(os.getenv("BACKFILL_CURSOR_BATCH_SIZE", 10000))
+rows_per_file = int(os.getenv("BACKFILL_ROWS_PER_FILE", 100000))
+checkpoint_lock = threading.Lock()
+
+
+
+def get_collection():
+    client = pymongo.MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    return client[os.getenv("MONGO_DB_NAME")][os.getenv("MONGO_WEATHER_COLLECTION_NAME")]
+
+
+
+def create_partitions(collection):
+    # Split the collection into ranges of _id by generation time, which is the time order of the documents
+    first_document = collection.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+    last_document = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if first_document is None:
+        return []
+    start = first_document["_id"].generation_time.timestamp()
+    end = last_document["_id"].generation_time.timestamp() + 1
+    step = (end - start) / partition_count
+    boundaries = [str(ObjectId.from_datetime(datetime.fromtimestamp(start + step * i, timezone.utc))) for i in range(partition_count)]
+    return [
+        {"start": boundaries[i], "end": boundaries[i + 1] if i + 1 < partition_count else None, "last_id": None, "next_file": 0, "done": False}
+        for i in range(partition_count)
+    ]
+
+
+
+def load_checkpoint(collection):
+    # Continue an interrupted backfill if a checkpoint exists, otherwise start a new one
+    if os.path.exists(checkpoint_file_path):
+        with open(checkpoint_file_path, "r") as f:
+            checkpoint = json.load(f)
+        print(f"Resuming the backfill: {sum(partition['done'] for partition in checkpoint['partitions'])} of {len(checkpoint['partitions'])} partition(s) are done")
+        return checkpoint
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = {"partitions": create_partitions(collection)}
+    save_checkpoint(checkpoint)
+    return checkpoint
+
+
+
+def save_checkpoint(checkpoint):
+    with checkpoint_lock:
+        temporary_file_path = checkpoint_file_path + ".tmp"
+        with open(temporary_file_path, "w") as f:
+            f.write(json.dumps(checkpoint, indent=4))
+        os.replace(temporary_file_path, checkpoint_file_path)
+
+
+
+def write_dead_letters(records):
+    # Append one JSON line per record, like the dead-letter file of the transfer daemon
+    with dead_letter_lock:
+        with open(dead_letter_file_path, "a") as f:
+            for record in records:
+                f.write(json_util.dumps(record) + "\n")
+    print(f"Wrote {len(records)} document(s) which cannot be converted to {dead_letter_file_path}")
+
+
+
+def flatten_valid_documents(documents):
+    # Flatten the whole list at once, and only look for the documents which fail one by one if it cannot be
+    try:
+        return flatten_documents(documents)
+    except Exception:
+        pass
+    valid_documents = []
+    dead_letters = []
+    for document in documents:
+        try:
+            flatten_documents([document])
+            valid_documents.append(document)
+        except Exception as e:
+            dead_letters.append({"error": str(e), "document": document})
+    write_dead_letters(dead_letters)
+    return flatten_documents(valid_documents) if len(valid_documents) != 0 else None
+
+
+
+def write_file(index, partition, documents):
+    file_name = os.path.join(output_dir, f"partition_{index:03}_{partition['next_file']:05}.parquet")
+    table = flatten_valid_documents(documents)
+    if table is None:
+        return None
+    pq.write_table(table, file_name)
+    return file_name
+
+
+
+def backfill_partition(collection, checkpoint, index):
+    # Write the documents of a partition to Parquet files, saving the position after each file
+    partition = checkpoint["partitions"][index]
+    if partition["done"]:
+        return 0
+    query = {"_id": {"$gte": ObjectId(partition["start"])}}
+    if partition["end"] is not None:
+        query["_id"]["$lt"] = ObjectId(partition["end"])
+    if partition["last_id"] is not None:
+        query["_id"]["$gt"] = ObjectId(partition["last_id"])
+    cursor = collection.find(query, {"location": 0}).sort("_id", 1).batch_size(cursor_batch_size)
+    documents = []
+    row_count = 0
+    for document in cursor:
+        last_id = str(document["_id"])
+        documents.append(document)
+        if len(documents) >= rows_per_file:
+            write_file(index, partition, documents)
+            row_count += len(documents)
+            documents = []
+            partition["last_id"] = last_id
+            partition["next_file"] += 1
+            save_checkpoint(checkpoint)
+    if len(documents) != 0:
+        write_file(index, partition, documents)
+        row_count += len(documents)
+        partition["last_id"] = last_id
+        partition["next_file"] += 1
+    partition["done"] = True
+    save_checkpoint(checkpoint)
+    return row_count
+
+
+
+def load_files(bigquery_client):
+    # Load the files into a staging table, then add the rows which are not in the weather table yet with one statement
+    # Like the transfer daemon, the rows of the places which are not in the places table are skipped
+    # Only the partitions of the days in the staging table are read, and the daily summary of those days is recomputed
+    staging_table_id = f"{weather_table_id}_backfill"
+    file_names = sorted(name for name in os.listdir(output_dir) if name.endswith(".parquet"))
+    for index, file_name in enumerate(file_names):
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE if index == 0 else bigquery.WriteDisposition.WRITE_APPEND
+        )
+        with open(os.path.join(output_dir, file_name), "rb") as f:
+            load_job = bigquery_client.load_table_from_file(f, f"{dataset_id}.{staging_table_id}", job_config=job_config)
+        load_job.result()
+        print(f"Loaded {file_name} ({load_job.output_rows} rows) into '{dataset_id}.{staging_table_id}' table")
+    if len(file_names) == 0:
+        print("No files to be loaded")
+        return
+    range_statement = f"""
+    SELECT TIMESTAMP_TRUNC(MIN(last_updated), DAY) AS start, TIMESTAMP_ADD(TIMESTAMP_TRUNC(MAX(last_updated), DAY), INTERVAL 1 DAY) AS end, ARRAY_AGG(DISTINCT place_id) AS place_ids
+    FROM `{dataset_id}.{staging_table_id}`
+    """
+    backfill_range = list(bigquery_client.query(range_statement).result())[0]
+    query_parameters = [
+        bigquery.ScalarQueryParameter("start", "TIMESTAMP", backfill_range["start"]),
+        bigquery.ScalarQueryParameter("end", "TIMESTAMP", backfill_range["end"]),
+        bigquery.ArrayQueryParameter("place_ids", "STRING", backfill_range["place_ids"])
+    ]
+    insert_statement = f"""
+    INSERT INTO `{dataset_id}.{weather_table_id}`
+    SELECT * FROM `{dataset_id}.{staging_table_id}` AS staging
+    WHERE staging.id NOT IN (SELECT id FROM `{dataset_id}.{weather_table_id}` WHERE last_updated >= @start AND last_updated < @end)
+    AND staging.place_id IN (SELECT place_id FROM `{dataset_id}.{places_table_id}`)
+    """
+    insert_job = bigquery_client.query(insert_statement, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters[:2]))
+    insert_job.result()
+    print(f"Successfully inserted {insert_job.num_dml_affected_rows} rows into '{dataset_id}.{weather_table_id}' table")
+    if maintain_daily_summary:
+        summary_statement = get_daily_summary_statement(f"{dataset_id}.{weather_table_id}", f"{dataset_id}.{daily_table_id}", "@start", "@end", "@place_ids")
+        bigquery_client.query(summary_statement, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters)).result()
+        print(f"Updated the daily summary of the backfilled days in '{dataset_id}.{daily_table_id}' table")
+    bigquery_client.delete_table(f"{dataset_id}.{staging_table_id}", not_found_ok=True)
+
+
+
+if __name__ == "__main__":
+    collection = get_collection()
+    checkpoint = load_checkpoint(collection)
+    print(f"Start backfilling {len(checkpoint['partitions'])} partition(s) with {worker_count} worker(s)")
+    failed = False
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = {executor.submit(backfill_partition, collection, checkpoint, index): index for index in range(len(checkpoint["partitions"]))}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                print(f"Partition {index} is done: {future.result()} rows written")
+            except Exception as e:
+                failed = True
+                print(f"Failed to backfill partition {index}. Error message: \"{e}\"\n{traceback.format_exc()}")
+    # Only load the files when every partition is complete, run the script again to resume otherwise
+    if failed:
+        print("The backfill was interrupted. Run this script again to resume it")
+    else:
+        load_files(bigquery.Client())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import zlib
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Run every stage of the pipeline against local stand-ins of the external services:
+# - a fake weather API server with configurable latency and staleness
+# - mongomock instead of MongoDB, and moto instead of S3 and SNS
+# - a recording fake of the BigQuery client with configurable job latency
+# Each stage and number of places runs in its own process so that its peak RSS is measured on its own
+script_dir = os.path.dirname(os.path.abspath(__file__))
+scales = [int(scale) for scale in os.getenv("BENCHMARK_SCALES", "63,1000,10000").split(",")]
+stages = os.getenv("BENCHMARK_STAGES", "fetch,insert,transfer").split(",")
+api_latency = float(os.getenv("BENCHMARK_API_LATENCY_MS", 50)) / 1000
+stale_percent = float(os.getenv("BENCHMARK_STALE_PERCENT", 5))
+bigquery_latency = float(os.getenv("BENCHMARK_BIGQUERY_LATENCY_MS", 200)) / 1000
+# The generated data and the retry jitter come from this seed, so runs can be compared with each other
+seed = int(os.getenv("BENCHMARK_SEED", 0))
+
+# Settings of the programs for the benchmark, unless they are already set
+benchmark_environment = {
+    "WEATHER_API_CONCURRENCY": "50",
+    "WEATHER_API_REQUESTS_PER_SECOND": "1000",
+    "RETRY_BASE_DELAY_SECONDS": "0.5",
+    "RETRY_MAX_DELAY_SECONDS": "2",
+    "AWS_ACCESS_KEY": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "REGION_NAME": "us-east-1",
+    "BUCKET_NAME": "benchmark",
+    "MONGO_CONNECTION_STRING": "mongodb://localhost:27017",
+    "MONGO_DB_NAME": "benchmark",
+    "MONGO_WEATHER_COLLECTION_NAME": "hourly_weather_data",
+    "BIGQUERY_DATASET_ID": "benchmark",
+    "BIGQUERY_PLACES_TABLE_ID": "places_info",
+    "BIGQUERY_WEATHER_TABLE_ID": "hourly_weather_data"
+}
+
+
+
+def get_expected_last_updated():
+    return (datetime.utcnow() + timedelta(hours=7)).replace(minute=0, second=0, microsecond=0)
+
+
+
+def create_place_coordinates(place_count):
+    return {f"place-{index}": {"lat": round(8 + index * 0.001, 5), "lon": round(102 + index * 0.001, 5)} for index in range(place_count)}
+
+
+
+def create_weather_response(query, last_updated):
+    # The same shape as the responses of the Realtime Weather API
+    lat, lon = query.split(",")
+    return {
+        "location": {"name": query, "region": "", "country": "Vietnam", "lat": float(lat), "lon": float(lon), "tz_id": "Asia/Ho_Chi_Minh", "localtime_epoch": int(last_updated.timestamp()), "localtime": last_updated.strftime("%Y-%m-%d %H:%M")},
+        "current": {
+            "last_updated_epoch": int(last_updated.replace(tzinfo=timezone.utc).timestamp()),
+            "last_updated": last_updated.strftime("%Y-%m-%d %H:%M"),
+            "temp_c": round(random.uniform(15, 35), 1), "temp_f": round(random.uniform(59, 95), 1), "is_day": random.randint(0, 1),
+            "condition": {"text": random.choice(["Sunny", "Partly cloudy", "Mist", "Light rain"]), "icon": "//cdn.weatherapi.com/weather/64x64/day/116.png", "code": 1003},
+            "wind_mph": 5.6, "wind_kph": 9.0, "wind_degree": random.randint(0, 359), "wind_dir": "SSW", "pressure_mb": 1010.0, "pressure_in": 29.83,
+            "precip_mm": round(random.uniform(0, 5), 2), "precip_in": 0.01, "humidity": random.randint(40, 100), "cloud": random.randint(0, 100),
+            "feelslike_c": 30.1, "feelslike_f": 86.2, "vis_km": 10.0, "vis_miles": 6.0, "uv": 6.0, "gust_mph": 8.1, "gust_kph": 13.0
+        }
+    }
+
+
+
+# A fake weather API which answers after a delay, with outdated data for the first request of some places
+class FakeWeatherAPIHandler(BaseHTTPRequestHandler):
+    request_counts = {}
+    lock = threading.Lock()
+    expected_last_updated = None
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)["q"][0]
+        with self.lock:
+            self.request_counts[query] = self.request_counts.get(query, 0) + 1
+            request_count = self.request_counts[query]
+        time.sleep(api_latency)
+        stale = request_count == 1 and zlib.crc32(query.encode()) % 10000 < stale_percent * 100
+        last_updated = self.expected_last_updated - timedelta(minutes=15) if stale else self.expected_last_updated
+        body = json.dumps(create_weather_response(query, last_updated)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+# A recording fake of the BigQuery client, whose jobs take a fixed time
+class FakeBigQueryJob:
+    def __init__(self, rows=(), output_rows=0, num_dml_affected_rows=0):
+        self.rows = list(rows)
+        self.output_rows = output_rows
+        self.num_dml_affected_rows = num_dml_affected_rows
+
+    def result(self):
+        time.sleep(bigquery_latency)
+        return self.rows
+
+
+
+class FakeBigQueryClient:
+    project = "benchmark"
+    place_ids = []
+
+    def __init__(self, *args, **kwargs):
+        self.jobs = []
+
+    def query(self, query, job_config=None):
+        self.jobs.append(query)
+        if "places_info" in query and "UNNEST" not in query:
+            return FakeBigQueryJob(rows=[{"place_id": place_id} for place_id in self.place_ids])
+        if query.strip().startswith(("MERGE", "DELETE")):
+            return FakeBigQueryJob(num_dml_affected_rows=1)
+        return FakeBigQueryJob()
+
+    def load_table_from_json(self, rows, table, job_config=None):
+        # Serialize the rows like the real client does before uploading them
+        data = "\n".join(json.dumps(row) for row in rows)
+        self.jobs.append(f"LOAD {table}")
+        return FakeBigQueryJob(output_rows=data.count("\n") + 1)
+
+    def create_table(self, table):
+        self.jobs.append(f"CREATE {table.dataset_id}.{table.table_id}")
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        pass
+
+
+
+# Keep the measurements of the metrics module in memory
+class RecordingExporter:
+    def __init__(self):
+        self.observations = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        with self.lock:
+            self.observations.setdefault(name, []).append(value)
+
+
+
+def get_percentile(values, percentile):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+
+def run_fetch(place_count, recorder):
+    import ingest_weather_data
+    FakeWeatherAPIHandler.expected_last_updated = ingest_weather_data.expected_last_updated
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeWeatherAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ingest_weather_data.weather_api_url = f"http://127.0.0.1:{server.server_address[1]}/current.json"
+    started_at = time.perf_counter()
+    weather_data, pending_places = ingest_weather_data.get_weather_data(create_place_coordinates(place_count), time.monotonic() + 600)
+    elapsed = time.perf_counter() - started_at
+    server.shutdown()
+    return elapsed, len(weather_data), recorder.observations.get("weather_api_fetch_seconds", [])
+
+
+
+def run_insert(place_count, recorder):
+    import mongomock
+    import ingest_weather_data
+    ingest_weather_data.pymongo.MongoClient = mongomock.MongoClient
+    documents = []
+    for place_id, coordinate in create_place_coordinates(place_count).items():
+        document = create_weather_response(f"{coordinate['lat']},{coordinate['lon']}", ingest_weather_data.expected_last_updated)
+        document["place_id"] = place_id
+        documents.append(document)
+    started_at = time.perf_counter()
+    inserter = ingest_weather_data.WeatherDataInserter()
+    for document in documents:
+        inserter.add(document)
+    inserter.close()
+    elapsed = time.perf_counter() - started_at
+    return elapsed, inserter.inserted_count, recorder.observations.get("mongo_insert_seconds", [])
+
+
+
+def run_transfer(place_count, recorder):
+    from google.cloud import bigquery
+    from bson.objectid import ObjectId
+    from bson.timestamp import Timestamp
+    from collections import deque
+    place_coordinates = create_place_coordinates(place_count)
+    FakeBigQueryClient.place_ids = list(place_coordinates)
+    bigquery.Client = FakeBigQueryClient
+    # The daemon writes its log to ../log and its resume token to a file, so both go to a temporary directory
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, "log"))
+    os.makedirs(os.path.join(work_dir, "work"))
+    os.chdir(os.path.join(work_dir, "work"))
+    os.environ["RESUME_TOKEN_FILE"] = os.path.join(work_dir, "resume_token.json")
+    import process_insert_update_weather_data as daemon
+    expected_last_updated = get_expected_last_updated()
+    batch = []
+    for index, (place_id, coordinate) in enumerate(place_coordinates.items()):
+        document = create_weather_response(f"{coordinate['lat']},{coordinate['lon']}", expected_last_updated)
+        document["_id"] = ObjectId()
+        document["place_id"] = place_id
+        batch.append({
+            "_id": {"_data": f"{index:016x}"},
+            "operationType": "insert",
+            "clusterTime": Timestamp(int(time.time()), index + 1),
+            "ns": {"db": "benchmark", "coll": "hourly_weather_data"},
+            "documentKey": {"_id": document["_id"]},
+            "fullDocument": document
+        })
+    started_at = time.perf_counter()
+    daemon.load_place_ids()
+    workers = [daemon.TransferWorker(index) for index in range(daemon.transfer_worker_count)]
+    for worker in workers:
+        worker.start()
+    in_flight = deque()
+    for start in range(0, len(batch), daemon.batch_size):
+        daemon.dispatch_batch(batch[start:start + daemon.batch_size], workers, in_flight)
+        daemon.commit_finished_batches(in_flight)
+    daemon.commit_finished_batches(in_flight, wait=True)
+    elapsed = time.perf_counter() - started_at
+    for worker in workers:
+        worker.queue.put(None)
+    return elapsed, len(batch), recorder.observations.get("transfer_flush_seconds", [])
+
+
+
+def run_stage(stage, place_count):
+    # Run one stage in this process and print its results as JSON
+    random.seed(seed)
+    for key, value in benchmark_environment.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, script_dir)
+    import logging
+    import metrics
+    from moto import mock_aws
+    recorder = RecordingExporter()
+    metrics.exporter = recorder
+    logging.basicConfig(level=logging.WARNING)
+    import ingest_weather_data
+    # Importing the ingestion module sets the log level to INFO for the Lambda function
+    logging.getLogger().setLevel(logging.WARNING)
+    ingest_weather_data.expected_last_updated = get_expected_last_updated()
+    with mock_aws():
+        import boto3
+        boto3.client("s3", region_name=os.environ["REGION_NAME"]).create_bucket(Bucket=os.environ["BUCKET_NAME"])
+        ingest_weather_data.ingestion_topic_arn = boto3.client("sns", region_name=os.environ["REGION_NAME"]).create_topic(Name="benchmark")["TopicArn"]
+        elapsed, item_count, latencies = {"fetch": run_fetch, "insert": run_insert, "transfer": run_transfer}[stage](place_count, recorder)
+    print(json.dumps({
+        "stage": stage,
+        "places": place_count,
+        "items": item_count,
+        "seconds": elapsed,
+        "throughput": item_count / elapsed if elapsed > 0 else None,
+        "p50": get_percentile(latencies, 50),
+        "p99": get_percentile(latencies, 99),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }))
+
+
+
+def format_milliseconds(value):
+    return f"{value * 1000:.1f}" if value is not None else "-"
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--run":
+        run_stage(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    print(f"{'stage':<10}{'places':>8}{'done':>8}{'seconds':>10}{'per second':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}{'peak RSS (MB)':>15}")
+    for stage in stages:
+        for place_count in scales:
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", stage, str(place_count)], capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"{stage:<10}{place_count:>8} failed:\n{completed.stderr}")
+                continue
+            result = json.loads(completed.stdout.strip().split("\n")[-1])
+            print(f"{stage:<10}{place_count:>8}{result['items']:>8}{result['seconds']:>10.2f}{result['throughput']:>12.1f}{format_milliseconds(result['p50']):>10}{format_milliseconds(result['p99']):>10}{result['peak_rss_mb']:>15.1f}")
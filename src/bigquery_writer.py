@@ -0,0 +1,206 @@
+from google.cloud import bigquery
+import os
+import json
+import uuid
+import logging
+import metrics
+from datetime import datetime, timedelta, timezone
+from transform_weather_data import read_table_schema
+
+
+
+# Keep every request well below the BigQuery limits (10 MB per request and 10,000 query parameters)
+max_request_bytes = int(os.getenv("BIGQUERY_MAX_REQUEST_BYTES", 8 * 1024 * 1024))
+max_request_rows = int(os.getenv("BIGQUERY_MAX_REQUEST_ROWS", 10000))
+# Staging tables expire by themselves, in case the process is killed before it deletes them
+staging_table_expiration = timedelta(hours=float(os.getenv("BIGQUERY_STAGING_TABLE_EXPIRATION_HOURS", 6)))
+
+
+
+def to_timestamp(value):
+    # Timestamps come as datetimes or as 'YYYY-MM-DD HH:MM[:SS]' strings, and are stored in UTC as before
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+
+# Convert Python values to the types of the columns in create_tables.sql
+converters = {
+    "STRING": str,
+    "INT64": int,
+    "FLOAT64": float,
+    "BOOL": bool,
+    "TIMESTAMP": to_timestamp
+}
+
+
+
+# The columns of the daily summary table and how they are computed from the hourly rows of a day
+daily_summary_columns = [
+    ("reading_count", "COUNT(*)"),
+    ("min_temp_c", "MIN(temp_c)"),
+    ("max_temp_c", "MAX(temp_c)"),
+    ("avg_temp_c", "AVG(temp_c)"),
+    ("total_precip_mm", "SUM(precip_mm)"),
+    ("avg_humidity", "AVG(humidity)"),
+    ("max_wind_kph", "MAX(wind_kph)"),
+    ("max_gust_kph", "MAX(gust_kph)"),
+    ("max_uv", "MAX(uv)")
+]
+
+
+
+def get_daily_summary_statement(weather_table, daily_table, start, end, place_ids):
+    # Recompute the daily summary of some places over the whole days between start and end from the hourly rows
+    # start, end and place_ids are SQL expressions (query parameters or script variables), so only those partitions are read
+    # Days whose rows are all gone are removed from the summary
+    columns = [column for column, _ in daily_summary_columns]
+    return f"""
+    MERGE `{daily_table}` AS target
+    USING (
+        SELECT place_id, DATE(last_updated) AS date, {', '.join(f'{expression} AS {column}' for column, expression in daily_summary_columns)}
+        FROM `{weather_table}`
+        WHERE last_updated >= {start} AND last_updated < {end} AND place_id IN UNNEST({place_ids})
+        GROUP BY place_id, date
+    ) AS source
+    ON target.place_id = source.place_id AND target.date = source.date AND target.date >= DATE({start}) AND target.date < DATE({end})
+    WHEN MATCHED THEN
+        UPDATE SET {', '.join(f'{column} = source.{column}' for column in columns)}, updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+        INSERT (place_id, date, {', '.join(columns)}, updated_at) VALUES (source.place_id, source.date, {', '.join(f'source.{column}' for column in columns)}, CURRENT_TIMESTAMP())
+    WHEN NOT MATCHED BY SOURCE AND target.date >= DATE({start}) AND target.date < DATE({end}) AND target.place_id IN UNNEST({place_ids}) THEN
+        DELETE
+    """
+
+
+
+class BigQueryWriter:
+    def __init__(self, client, dataset_id, table_id, table_name, partition_column=None):
+        self.client = client
+        self.table = f"{dataset_id}.{table_id}"
+        # The TIMESTAMP column the table is partitioned by day on, if any
+        self.partition_column = partition_column
+        # table_name is the name of the table in create_tables.sql, which gives the columns and their types
+        self.schema = read_table_schema(table_name)
+        self.column_types = {column: column_type for column, column_type, _ in self.schema}
+        self.bigquery_schema = [bigquery.SchemaField(column, column_type, mode="REQUIRED" if required else "NULLABLE") for column, column_type, required in self.schema]
+
+    def to_typed_row(self, row):
+        # Keep only the columns of the table, converted to their types
+        return {
+            column: converters[self.column_types[column]](value) if value is not None else None
+            for column, value in row.items() if column in self.column_types
+        }
+
+    def validate_row(self, row):
+        # Raise the error a load job would fail on for this row: a missing required column or a value of the wrong type
+        for column, _, required in self.schema:
+            if required and row.get(column) is None:
+                raise ValueError(f"The required column '{column}' is missing")
+        return self.to_json_row(row)
+
+    def to_json_row(self, row):
+        return {column: value.isoformat() if isinstance(value, datetime) else value for column, value in self.to_typed_row(row).items()}
+
+    def get_partition_range(self, values):
+        # Get the start of the first day and the end of the last day of some timestamps, or None if there are none
+        days = {to_timestamp(value).replace(hour=0, minute=0, second=0, microsecond=0) for value in values}
+        if len(days) == 0:
+            return None
+        return min(days), max(days) + timedelta(days=1)
+
+    def get_partition_filter(self, column_prefix, partition_range):
+        # Restrict a statement to the partitions of a range, so the other days are not scanned
+        if self.partition_column is None or partition_range is None:
+            return "", []
+        query_parameters = [
+            bigquery.ScalarQueryParameter("partition_start", "TIMESTAMP", partition_range[0]),
+            bigquery.ScalarQueryParameter("partition_end", "TIMESTAMP", partition_range[1])
+        ]
+        column = f"{column_prefix}{self.partition_column}"
+        return f"AND {column} >= @partition_start AND {column} < @partition_end", query_parameters
+
+    def split_into_chunks(self, rows):
+        # Split the rows so that every request stays under the size and row limits
+        chunk = []
+        chunk_bytes = 0
+        for row in rows:
+            row_bytes = len(json.dumps(row)) + 1
+            if len(chunk) != 0 and (chunk_bytes + row_bytes > max_request_bytes or len(chunk) >= max_request_rows):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if len(chunk) != 0:
+            yield chunk
+
+    def load_rows(self, rows, table):
+        # Load the rows with load jobs instead of INSERT statements
+        job_config = bigquery.LoadJobConfig(
+            schema=self.bigquery_schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        loaded_count = 0
+        for chunk in self.split_into_chunks(self.to_json_row(row) for row in rows):
+            with metrics.timer("bigquery_job_seconds", statement="load"):
+                load_job = self.client.load_table_from_json(chunk, table, job_config=job_config)
+                load_job.result()
+            loaded_count += load_job.output_rows
+        return loaded_count
+
+    def insert_rows(self, rows):
+        inserted_count = self.load_rows(rows, self.table)
+        logging.info(f"Inserted {inserted_count} row(s) into '{self.table}' table")
+        return inserted_count
+
+    def create_staging_table(self, staging_table):
+        table = bigquery.Table(bigquery.TableReference.from_string(staging_table, default_project=self.client.project), schema=self.bigquery_schema)
+        table.expires = datetime.now(timezone.utc) + staging_table_expiration
+        self.client.create_table(table)
+
+    def merge_rows(self, rows, key_column, partition_range=None):
+        # Load the rows into a staging table of their own, then update or insert all of them with one MERGE statement
+        # With a partition range, only the target rows of those days are matched, so the existing version of a row must be in the range too
+        staging_table = f"{self.table}_staging_{uuid.uuid4().hex}"
+        columns = [column for column, _, _ in self.schema]
+        partition_filter, query_parameters = self.get_partition_filter("target.", partition_range)
+        merge_statement = f"""
+        MERGE `{self.table}` AS target
+        USING `{staging_table}` AS source
+        ON target.{key_column} = source.{key_column} {partition_filter}
+        WHEN MATCHED THEN
+            UPDATE SET {', '.join(f'{column} = source.{column}' for column in columns if column != key_column)}
+        WHEN NOT MATCHED THEN
+            INSERT ({', '.join(columns)}) VALUES ({', '.join(f'source.{column}' for column in columns)})
+        """
+        try:
+            self.create_staging_table(staging_table)
+            self.load_rows(rows, staging_table)
+            with metrics.timer("bigquery_job_seconds", statement="merge"):
+                merge_job = self.client.query(merge_statement, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+                merge_job.result()
+        finally:
+            self.client.delete_table(staging_table, not_found_ok=True)
+        logging.info(f"Merged {merge_job.num_dml_affected_rows} row(s) into '{self.table}' table")
+        return merge_job.num_dml_affected_rows
+
+    def select_existing(self, column, values, partition_range=None):
+        # Get which of the values exist in a column, with one query per chunk of values
+        existing_values = set()
+        partition_filter, partition_parameters = self.get_partition_filter("", partition_range)
+        query = f"""
+        SELECT DISTINCT {column}
+        FROM `{self.table}`
+        WHERE {column} IN UNNEST(@values) {partition_filter}
+        """
+        for chunk in self.split_into_chunks(values):
+            query_parameters = [bigquery.ArrayQueryParameter("values", self.column_types[column], chunk)] + partition_parameters
+            with metrics.timer("bigquery_job_seconds", statement="select"):
+                query_job = self.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+                existing_values.update(row[column] for row in query_job.result())
+        return existing_values
@@ -38,4 +38,34 @@ CREATE TABLE vn_weather_data.hourly_weather_data (
   wind_dir STRING,
   wind_kph FLOAT64,
   wind_mph FLOAT64
-);
\ No newline at end of file
+)
+-- Lookups by id or place_id only read the partitions of the days they ask for
+PARTITION BY DATE(last_updated)
+CLUSTER BY place_id, id;
+
+-- Create a table to store the ids of weather documents deleted from MongoDB until they are deleted from hourly_weather_data
+-- last_updated comes from the timestamp of the id, so compactions only read the partitions of the deleted rows
+CREATE TABLE vn_weather_data.hourly_weather_data_tombstones (
+  id STRING NOT NULL,
+  last_updated TIMESTAMP,
+  deleted_at TIMESTAMP NOT NULL,
+  recorded_at TIMESTAMP NOT NULL
+);
+
+-- Create a table to store a daily summary of the weather of each place, which is updated as the hourly data lands
+CREATE TABLE vn_weather_data.hourly_weather_data_daily (
+  place_id STRING NOT NULL,
+  date DATE NOT NULL,
+  reading_count INT64 NOT NULL,
+  min_temp_c FLOAT64,
+  max_temp_c FLOAT64,
+  avg_temp_c FLOAT64,
+  total_precip_mm FLOAT64,
+  avg_humidity FLOAT64,
+  max_wind_kph FLOAT64,
+  max_gust_kph FLOAT64,
+  max_uv FLOAT64,
+  updated_at TIMESTAMP NOT NULL
+)
+PARTITION BY date
+CLUSTER BY place_id;
\ No newline at end of file
@@ -4,6 +4,7 @@ import pymongo
 import os
 from dotenv import load_dotenv
 import json
+from place_registry import PlaceRegistry, create_indexes
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,12 +15,16 @@ collection_name = os.getenv("MONGO_PLACES_COLLECTION_NAME")
 # Query the place coordinates
 client = pymongo.MongoClient(connection_string)
 collection = client[database_name][collection_name]
-documents = collection.find({}, {'place_id': 1, 'lat': 1, 'lon': 1})
-place_coordinates = {document['place_id']:{'lat':float(document['lat'][:-1]), 'lon':float(document['lon'][:-1])} for document in documents}
+create_indexes(collection)
+place_registry = PlaceRegistry(collection)
+place_coordinates = place_registry.refresh(force=True).coordinates
 
 # Write data to a file
 script_dir = os.path.dirname(os.path.abspath(__file__))
 file_path = os.path.join(script_dir, '../data/place_coordinates.json')
 with open(file_path, "w") as f:
     f.write(json.dumps(place_coordinates, indent=4))
+
+# Also write a snapshot of the place registry, from which the Lambda function and the daemon only read the places added later
+place_registry.save(os.path.join(script_dir, '../data'))
 print(f"Successfully extracted coordinate data of {len(place_coordinates)} places")
\ No newline at end of file
@@ -0,0 +1,57 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+from transform_weather_data import read_table_schema
+
+
+
+# Map the BigQuery types of create_tables.sql to Arrow types
+arrow_types = {
+    "STRING": pa.string(),
+    "INT64": pa.int64(),
+    "FLOAT64": pa.float64(),
+    "BOOL": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC")
+}
+weather_schema = read_table_schema("hourly_weather_data")
+arrow_schema = pa.schema([pa.field(column, arrow_types[column_type], nullable=not required) for column, column_type, required in weather_schema])
+
+# The type of the nested 'current' document as it comes from the weather API, keeping only the columns of the table
+# 'condition' is a document, and 'is_day' and 'last_updated' are converted after being read
+current_fields = []
+for column, column_type, _ in weather_schema:
+    if column in ["id", "place_id"]:
+        continue
+    elif column == "condition":
+        current_fields.append(pa.field("condition", pa.struct([pa.field("text", pa.string())])))
+    elif column == "is_day":
+        current_fields.append(pa.field("is_day", pa.int64()))
+    elif column == "last_updated":
+        current_fields.append(pa.field("last_updated", pa.string()))
+    else:
+        current_fields.append(pa.field(column, arrow_types[column_type]))
+current_type = pa.struct(current_fields)
+
+
+
+def flatten_documents(documents):
+    # Build the columns of the hourly_weather_data table from a list of raw weather documents at once
+    # The result has the same values as process_document, with last_updated as a timestamp
+    documents = list(documents)
+    current = pa.array([document["current"] for document in documents], type=current_type)
+    columns = {
+        "id": pa.array([str(document["_id"]) for document in documents], type=pa.string()),
+        "place_id": pa.array([document["place_id"] for document in documents], type=pa.string())
+    }
+    for column, _, _ in weather_schema:
+        if column in columns:
+            continue
+        elif column == "condition":
+            columns[column] = pc.struct_field(pc.struct_field(current, "condition"), "text")
+        elif column == "is_day":
+            columns[column] = pc.fill_null(pc.not_equal(pc.struct_field(current, "is_day"), 0), False)
+        elif column == "last_updated":
+            last_updated = pc.strptime(pc.struct_field(current, "last_updated"), format="%Y-%m-%d %H:%M", unit="us")
+            columns[column] = pc.assume_timezone(last_updated, "UTC")
+        else:
+            columns[column] = pc.struct_field(current, column)
+    return pa.Table.from_pydict(columns, schema=arrow_schema)
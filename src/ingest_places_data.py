@@ -5,10 +5,15 @@ import pymongo
 import os
 from dotenv import load_dotenv
 import json
-from fuzzywuzzy import fuzz
+import hashlib
+import threading
+from rapidfuzz import process, fuzz
 from pprint import pprint
-import time
 import traceback
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limiter import RateLimiter
+from place_registry import create_indexes
 
 # Load environment variables
 load_dotenv()
@@ -19,61 +24,144 @@ file_path = os.path.join(script_dir, "../data/place_names.json")
 with open(file_path, "r") as f:
     place_names = json.load(f)
 
+# Set up the place resolution
+url = "https://ai-weather-by-meteosource.p.rapidapi.com/find_places"
+headers = {
+    "X-RapidAPI-Key": os.getenv("PLACES_API_KEY"),
+    "X-RapidAPI-Host": "ai-weather-by-meteosource.p.rapidapi.com"
+}
+concurrency = int(os.getenv("PLACES_API_CONCURRENCY", 4))
+requests_per_second = float(os.getenv("PLACES_API_REQUESTS_PER_SECOND", 1))
+cache_dir = os.getenv("PLACES_CACHE_DIR", os.path.join(script_dir, "../data/places_cache"))
+checkpoint_file_path = os.path.join(script_dir, "../data/places_checkpoint.json")
+checkpoint_interval = int(os.getenv("PLACES_CHECKPOINT_INTERVAL", 20))
+# Set when the API answers with an error (e.g. the quota is used up), so no more requests are sent
+stop_requested = threading.Event()
+
+
+
+def get_cache_file_path(querystring):
+    # One file per query, named after a hash of the query text
+    key = hashlib.sha1(json.dumps(querystring, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+
+def read_cache(querystring):
+    # Return whether the response of the query is cached, and the response (which may be None)
+    cache_file_path = get_cache_file_path(querystring)
+    if not os.path.exists(cache_file_path):
+        return False, None
+    with open(cache_file_path, "r") as f:
+        return True, json.load(f)["response"]
+
+
+
+def write_cache(querystring, response):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file_path = get_cache_file_path(querystring)
+    temporary_file_path = f"{cache_file_path}.{threading.get_ident()}.tmp"
+    with open(temporary_file_path, "w") as f:
+        f.write(json.dumps({"query": querystring, "response": response}, indent=4))
+    os.replace(temporary_file_path, cache_file_path)
+
+
+
+def load_checkpoint():
+    # Continue an interrupted run with the places it already resolved
+    if not os.path.exists(checkpoint_file_path):
+        return {}
+    with open(checkpoint_file_path, "r") as f:
+        return json.load(f)
+
+
+
+def save_checkpoint(places_data):
+    temporary_file_path = checkpoint_file_path + ".tmp"
+    with open(temporary_file_path, "w") as f:
+        f.write(json.dumps(places_data, indent=4))
+    os.replace(temporary_file_path, checkpoint_file_path)
+
+
+
+def fetch_place(session, rate_limiter, place):
+    # Return the response of the API for a place and an error, from the cache if the same query was sent before
+    querystring = {"text":place["en"],"language":"en"}
+    found, response = read_cache(querystring)
+    if found:
+        return response, None
+    if stop_requested.is_set():
+        return None, "Not requested because of an earlier error"
+    try:
+        rate_limiter.acquire()
+        response = session.get(url, headers=headers, params=querystring, timeout=30).json()
+    except Exception as e:
+        return None, str(e)
+    # If it is a dictionary, the request is not successful
+    if type(response) == dict:
+        stop_requested.set()
+        return None, response.get("message")
+    write_cache(querystring, response)
+    return response, None
+
+
+
+def choose_place(place, response):
+    # If the response is None, there is no match for the place
+    if response == None or len(response) == 0:
+        return "Not found"
+    if len(response) == 1:
+        return response[0]
+    # Otherwise take the place in Vietnam whose name is the most similar to the English or Vietnamese name
+    candidates = [result for result in response if result["country"] == "Socialist Republic of Vietnam"]
+    candidate_names = [result["name"].lower() for result in candidates]
+    best_match = None
+    for name in [place["en"].lower(), place["vi"].lower()]:
+        match = process.extractOne(name, candidate_names, scorer=fuzz.ratio)
+        if match is not None and (best_match is None or match[1] > best_match[1]):
+            best_match = match
+    return candidates[best_match[2]] if best_match is not None else "Not found"
+
 
 
 def get_places_data(place_names):
-    url = "https://ai-weather-by-meteosource.p.rapidapi.com/find_places"
-    headers = {
-        "X-RapidAPI-Key": os.getenv("PLACES_API_KEY"),
-        "X-RapidAPI-Host": "ai-weather-by-meteosource.p.rapidapi.com"
-    }
-    places_data = {}
-    print(f"\nGetting places data for {len(place_names)} places...")
-    
-    for index, place in enumerate(place_names):
-        en_name = place["en"]
-        vi_name = place["vi"]
-        places_data[en_name] = "Not found"
-        querystring = {"text":en_name,"language":"en"}
-        response = requests.get(url, headers=headers, params=querystring).json()
-        
-        # Check the type of the response
-        # If it is a dictionary, the request is not successful
-        if type(response) == dict:
-            print(f"The request is not successful.\nError message: {response['message']}\n")
-            break
-        # If the response is None, there is no match for the place
-        elif response == None:
-            continue
-        # If it is a list, the place is FOUND
-        elif type(response) == list:
-            if len(response) == 1:
-                places_data[en_name] = response[0]
+    places_data = load_checkpoint()
+    pending_places = [(index, place) for index, place in enumerate(place_names) if place["en"] not in places_data]
+    print(f"\nGetting places data for {len(pending_places)} places ({len(places_data)} already resolved)...")
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    rate_limiter = RateLimiter(requests_per_second)
+    failed_count = 0
+    resolved_count = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(fetch_place, session, rate_limiter, place): (index, place) for index, place in pending_places}
+        for future in as_completed(futures):
+            index, place = futures[future]
+            response, error = future.result()
+            if error is not None:
+                print(f"{index + 1}. The request for {place['en']} is not successful.\nError message: {error}\n")
+                failed_count += 1
+                continue
+            places_data[place["en"]] = choose_place(place, response)
+            # Check if the place data is found
+            if places_data[place["en"]] == "Not found":
+                print(f"{index + 1}. {place['en']} was NOT FOUND")
             else:
-                max_similarity = 0
-                most_similar_place = None
-                for result in response:
-                    if result["country"] != "Socialist Republic of Vietnam":
-                        continue
-                    en_similarity = fuzz.ratio(en_name.lower(), result["name"].lower())
-                    vi_similarity = fuzz.ratio(vi_name.lower(), result["name"].lower())
-                    if en_similarity == 100:
-                        most_similar_place = result
-                        break
-                    more_similar = max(vi_similarity, en_similarity)
-                    if more_similar > max_similarity:
-                        max_similarity = more_similar
-                        most_similar_place = result
-                places_data[en_name] = most_similar_place
-        # Check if the place data is found
-        if places_data[en_name] == "Not found":
-            print(f"{index + 1}. {en_name} was NOT FOUND")
-        else:
-            print(f"{index + 1}. {en_name} was FOUND")
-        # Wait 1s before continuing with the next place
-        time.sleep(3)
-    
-    return places_data
+                print(f"{index + 1}. {place['en']} was FOUND")
+            # Save the progress from time to time, so an interrupted run can resume
+            resolved_count += 1
+            if resolved_count % checkpoint_interval == 0:
+                save_checkpoint(places_data)
+    session.close()
+
+    if failed_count != 0:
+        save_checkpoint(places_data)
+        print(f"{failed_count} place(s) could not be resolved. Run this script again to resume")
+        return None
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+    # Keep the order of the place names
+    return {place["en"]: places_data[place["en"]] for place in place_names}
 
 
 
@@ -87,13 +175,15 @@ def insert_places_data(places_data):
         print("\nNo data to be inserted")
         return
     # Restructure data
-    documents = [data for place, data in places_data.items()]
+    # updated_at lets the place registry pick up the new places without reading the whole collection
+    documents = [dict(data, updated_at=datetime.now(timezone.utc)) for place, data in places_data.items() if isinstance(data, dict)]
     # Connect to MongoDB
     client = pymongo.MongoClient(connection_string)
     try:
         client.server_info()
         print("Successfully connected to MongoDB")
         collection = client[database_name][collection_name]
+        create_indexes(collection)
         # Insert data
         try:
             print(f"Start inserting {len(documents)} documents into '{database_name}.{collection_name}' collection")
@@ -112,4 +202,5 @@ def insert_places_data(places_data):
 # Get places data and insert to MongoDB
 if __name__ == "__main__":
     places_data = get_places_data(place_names)
-    insert_places_data(places_data)
\ No newline at end of file
+    if places_data is not None:
+        insert_places_data(places_data)
\ No newline at end of file
@@ -7,9 +7,47 @@ import os
 import logging
 import traceback
 import time
-import boto3
+import threading
+import random
+import heapq
+import hashlib
+from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+import metrics
+from place_registry import PlaceRegistry
+from rate_limiter import RateLimiter
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Load the configuration once per container, so warm invocations of the Lambda function skip it
+load_dotenv()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+weather_api_url = os.getenv("WEATHER_API_URL", "https://weatherapi-com.p.rapidapi.com/current.json")
+weather_api_key = os.getenv("WEATHER_API_KEY")
+concurrency = int(os.getenv("WEATHER_API_CONCURRENCY", 10))
+requests_per_second = float(os.getenv("WEATHER_API_REQUESTS_PER_SECOND", 5))
+retry_base_delay = float(os.getenv("RETRY_BASE_DELAY_SECONDS", 10))
+retry_max_delay = float(os.getenv("RETRY_MAX_DELAY_SECONDS", 60))
+insert_chunk_size = int(os.getenv("INSERT_CHUNK_SIZE", 100))
+insert_max_retries = int(os.getenv("INSERT_MAX_RETRIES", 2))
+insert_time_reserve = float(os.getenv("INSERT_TIME_RESERVE_SECONDS", 30))
+fetch_time_budget = float(os.getenv("FETCH_TIME_BUDGET_SECONDS", 270))
+mongo_server_selection_timeout_ms = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+ingestion_topic_arn = os.getenv("INGESTION_TOPIC_ARN")
+bucket_name = os.getenv("BUCKET_NAME")
+
+# The coordinates are in the data directory next to this file when it is deployed, and in ../data in this repo
+script_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(script_dir, "data") if os.path.isdir(os.path.join(script_dir, "data")) else os.path.join(script_dir, "../data")
+
+# The place registry and the clients are created on first use, then kept for the next invocations of the same container
+place_registry = None
+http_session = None
+aws_session = None
+mongo_client = None
+weather_collection = None
+expected_last_updated = None
 
 
 
@@ -18,11 +56,24 @@ def format_traceback():
 
 
 
+def create_session():
+    # boto3 is slow to import and only needed when something has to be saved or reported, so it is imported here
+    global aws_session
+    if aws_session is None:
+        import boto3
+        aws_session = boto3.Session(
+            aws_access_key_id = os.getenv("AWS_ACCESS_KEY"),
+            aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY"),
+            region_name = os.getenv("REGION_NAME"))
+    return aws_session
+
+
+
 def notify_error(session, message):
     sns_client = session.client("sns")
     try:
         sns_client.publish(
-            TopicArn = os.getenv("INGESTION_TOPIC_ARN"),
+            TopicArn = ingestion_topic_arn,
             Subject = "Failure occured while ingesting weather data to MongoDB",
             Message = message
         )
@@ -37,7 +88,7 @@ def save_to_s3(session, saved_data):
     file_name = 'failed_inserts_' + ''.join(character for character in str(expected_last_updated) if character not in ["-", " ", ":"]) + '.json'
     try:
         s3 = session.resource('s3')
-        s3.Object(os.getenv("BUCKET_NAME"), file_name).put(Body=json.dumps(data, indent=4))
+        s3.Object(bucket_name, file_name).put(Body=json.dumps(data, indent=4))
         logger.info(f"Sucessfully saved {file_name} to S3")
     except Exception as e:
         message = f"An error occurred while trying to save data to S3: {e}. {format_traceback()}."
@@ -46,117 +97,376 @@ def save_to_s3(session, saved_data):
 
 
 
-def get_weather_data(place_coordinates):
-    url = "https://weatherapi-com.p.rapidapi.com/current.json"
+def get_pending_places_file_name():
+    return 'pending_places_' + ''.join(character for character in str(expected_last_updated) if character not in ["-", " ", ":"]) + '.json'
+
+
+
+def save_pending_places(session, pending_places):
+    # Hand the places which are still missing over to a later run of the same hour, with their retry state
+    file_name = get_pending_places_file_name()
+    try:
+        s3 = session.resource('s3')
+        s3.Object(bucket_name, file_name).put(Body=json.dumps(pending_places, indent=4))
+        logger.info(f"Sucessfully saved {len(pending_places)} pending place(s) to {file_name} on S3")
+    except Exception as e:
+        message = f"An error occurred while trying to save pending places to S3: {e}. {format_traceback()}."
+        logger.error(message)
+        notify_error(session, message)
+
+
+
+def load_pending_places(session):
+    file_name = get_pending_places_file_name()
+    try:
+        s3 = session.resource('s3')
+        pending_places = json.loads(s3.Object(bucket_name, file_name).get()["Body"].read())
+        logger.info(f"Loaded {len(pending_places)} pending place(s) from {file_name} on S3")
+        return pending_places
+    except Exception as e:
+        logger.warning(f"Failed to load pending places from {file_name} on S3. Error: {e}")
+        return None
+
+
+
+def load_place_coordinates():
+    # Load the deployed snapshot of the places once per container, and use the latest refreshed version after that
+    global place_registry
+    if place_registry is None:
+        places_collection_name = os.getenv("MONGO_PLACES_COLLECTION_NAME")
+        places_collection = get_mongo_client()[os.getenv("MONGO_DB_NAME")][places_collection_name] if places_collection_name else None
+        place_registry = PlaceRegistry(places_collection)
+        place_registry.load(data_dir)
+    return place_registry.get_snapshot().coordinates
+
+
+
+def refresh_place_registry():
+    # Pick up the places added since the snapshot from MongoDB, for the next invocations of the container
+    # It runs on the worker of the inserter while the data is being fetched, so it never delays the first request
+    snapshot = place_registry.get_snapshot()
+    if snapshot.last_id is None:
+        # Without the cursor of a snapshot, a refresh would read the whole collection
+        logger.warning("The place registry has no cursor, deploy the snapshot written by extract_coordinates.py to pick up new places")
+        return
+    try:
+        place_registry.refresh()
+    except Exception as e:
+        logger.warning(f"Failed to refresh the places from MongoDB, using version {snapshot.version} of the place registry. Error: {e}")
+
+
+
+def get_http_session():
+    # Share one pooled session between the threads and the invocations, so connections are reused
+    global http_session
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+    return http_session
+
+
+
+def fetch_weather_data(session, rate_limiter, place_id, coordinate):
     headers = {
-        "X-RapidAPI-Key": os.getenv("WEATHER_API_KEY"),
+        "X-RapidAPI-Key": weather_api_key,
         "X-RapidAPI-Host": "weatherapi-com.p.rapidapi.com"
     }
+    try:
+        rate_limiter.acquire()
+        querystring = {"q":f"{coordinate['lat']},{coordinate['lon']}"}
+        with metrics.timer("weather_api_fetch_seconds"):
+            response = session.get(weather_api_url, headers=headers, params=querystring, timeout=30).json()
+        if datetime.strptime(response["current"]["last_updated"]+":00", "%Y-%m-%d %H:%M:%S") == expected_last_updated:
+            response["place_id"] = place_id
+            logger.info(f"Got {place_id}")
+            metrics.increment("weather_api_requests", outcome="ok")
+            return response, None
+        else:
+            error = f"Expect ['current']['last_updated'] as {expected_last_updated}, got {response['current']['last_updated']}"
+            logger.warning(f"Failed to get weather data for '{place_id}'. {error}")
+            metrics.increment("weather_api_requests", outcome="stale")
+            return None, error
+    except Exception as e:
+        logger.warning(f"Failed to get weather data for {place_id}. Error: {e}")
+        metrics.increment("weather_api_requests", outcome="error")
+        return None, str(e)
+
+
+
+def get_retry_delay(attempts):
+    # Exponential backoff with jitter, so stale places are not all retried at the same moment
+    return min(retry_max_delay, retry_base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+
+
+
+def get_weather_data(place_coordinates, deadline, place_states=None, sink=None):
+    rate_limiter = RateLimiter(requests_per_second)
+    session = get_http_session()
+    # Hand every document to the sink as soon as it arrives, or collect them if there is no sink
     weather_data = []
+    if sink is None:
+        sink = weather_data.append
+    got_count = 0
+    # Keep the retry state of every place (continued from a previous run if given)
+    states = {place_id: {"coordinate": coordinate, "attempts": 0, "last_error": None} for place_id, coordinate in place_coordinates.items()}
+    for place_id, state in (place_states or {}).items():
+        if place_id in states:
+            states[place_id].update(attempts=state["attempts"], last_error=state["last_error"])
+    # Each place waits in a heap ordered by the time it may be requested again
+    scheduled_places = [(time.monotonic(), place_id) for place_id in place_coordinates]
+    heapq.heapify(scheduled_places)
+    running = {}
     logger.info(f"Start getting weather data at {expected_last_updated} for {len(place_coordinates)} places")
-    # Start a loop to try getting weather data for each place in up to 3 times
-    for i in range(3):
-        failed_places = {}
-        for place_id, coordinate in place_coordinates.items():
-            try:
-                querystring = {"q":f"{coordinate['lat']},{coordinate['lon']}"}
-                response = requests.get(url, headers=headers, params=querystring).json()
-                if datetime.strptime(response["current"]["last_updated"]+":00", "%Y-%m-%d %H:%M:%S") == expected_last_updated:
-                    response["place_id"] = place_id
-                    weather_data.append(response)
-                    logger.info(f"Got {place_id}")
+    # The pool is not used as a context manager, whose exit would wait for the requests still in flight past the deadline
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        while (len(scheduled_places) != 0 or len(running) != 0) and time.monotonic() < deadline:
+            # Send the requests of the places which are due, keeping the pool busy
+            while len(scheduled_places) != 0 and scheduled_places[0][0] <= time.monotonic() and len(running) < concurrency:
+                _, place_id = heapq.heappop(scheduled_places)
+                states[place_id]["attempts"] += 1
+                running[executor.submit(fetch_weather_data, session, rate_limiter, place_id, states[place_id]["coordinate"])] = place_id
+            # Wait until a request finishes, the next retry is due or the deadline is reached
+            wake_up_at = deadline if len(scheduled_places) == 0 else min(deadline, scheduled_places[0][0])
+            timeout = max(0, wake_up_at - time.monotonic())
+            if len(running) == 0:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                place_id = running.pop(future)
+                response, error = future.result()
+                if response is not None:
+                    sink(response)
+                    got_count += 1
+                    del states[place_id]
                 else:
-                    logger.warning(f"Failed to get weather data for '{place_id}'. Expect ['current']['last_updated'] as {expected_last_updated}, got {response['current']['last_updated']}")
-                    failed_places[place_id] = coordinate
-                    continue
-            except Exception as e:
-                logger.warning(f"Failed to get weather data for {place_id}. Error: {e}")
-                failed_places[place_id] = coordinate
+                    states[place_id]["last_error"] = error
+                    retry_at = time.monotonic() + get_retry_delay(states[place_id]["attempts"])
+                    if retry_at < deadline:
+                        heapq.heappush(scheduled_places, (retry_at, place_id))
+                        metrics.increment("weather_api_retries")
+        # Keep what the requests which finished by the deadline returned, without waiting for the others
+        done, _ = wait(running, timeout=0)
+        for future, place_id in running.items():
+            if future not in done:
+                states[place_id]["last_error"] = "The request was still in flight at the deadline"
                 continue
-        if len(failed_places) == 0:
-            break
-        else:
-            if i in range(2):
-                logger.info(f"Retrying to get weather data for {len(failed_places)} place(s)")
-                place_coordinates = failed_places
-                time.sleep(60)
+            response, error = future.result()
+            if response is not None:
+                sink(response)
+                got_count += 1
+                del states[place_id]
             else:
-                break
-    # Log and return the weather data
-    if len(failed_places) == 0:
+                states[place_id]["last_error"] = error
+    finally:
+        # Abandon the requests still in flight, their places stay pending for the next run
+        executor.shutdown(wait=False, cancel_futures=True)
+    # Log and return the weather data with the places which are still missing
+    if len(states) == 0:
         logger.info(f"Successfully got weather data at {expected_last_updated} for all places")
     else:
-        logger.info(f"Successfully got data for {len(weather_data)} places at {expected_last_updated}, failed for {len(failed_places)} place(s) {list(failed_places.keys())}.")
-    return weather_data
+        logger.info(f"Successfully got data for {got_count} places at {expected_last_updated}, failed for {len(states)} place(s) {list(states.keys())}.")
+    return weather_data, states
 
 
 
-def insert_weather_data(weather_data=None):
-    # Create a session for later use (if necessary)
-    session = boto3.Session(
-        aws_access_key_id = os.getenv("AWS_ACCESS_KEY"),
-        aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY"),
-        region_name = os.getenv("REGION_NAME"))
-    
-    # Get values of environment variables for MongoDB
-    connection_string = os.getenv("MONGO_CONNECTION_STRING")
-    database_name = os.getenv("MONGO_DB_NAME")
-    collection_name = os.getenv("MONGO_WEATHER_COLLECTION_NAME")
-    
-    # Connect to MongoDB
-    client = pymongo.MongoClient(connection_string)
-    try:
-        client.server_info()
+def get_document_id(document):
+    # Build the same ObjectId for the same place and hour, so re-runs and replays never create duplicates
+    # Its timestamp part is last_updated_epoch and the rest comes from a hash of place_id, so ids stay ordered by time
+    place_hash = hashlib.sha1(document["place_id"].encode()).digest()[:8]
+    return ObjectId(document["current"]["last_updated_epoch"].to_bytes(4, "big") + place_hash)
+
+
+
+def to_stored_document(document):
+    # Store a slimmer document: 'location' repeats the same data of a place every hour
+    # last_updated_at is the time of the reading as a date, which the TTL and the range index of the collection use
+    # inserted_at is the time of the insert, which can be hours after the reading for a resumed run or a replay, so the daemon catches up on it
+    stored_document = {key: value for key, value in document.items() if key != "location"}
+    stored_document["last_updated_at"] = datetime.fromtimestamp(document["current"]["last_updated_epoch"], timezone.utc)
+    stored_document["inserted_at"] = datetime.now(timezone.utc)
+    return stored_document
+
+
+
+def create_indexes(collection):
+    # The daemon catches up on the documents inserted since a time
+    collection.create_index([("inserted_at", pymongo.ASCENDING)], name="inserted_at")
+    # Reject a second document of the same place and hour, including old documents with generated ObjectIds
+    # It cannot be built while the collection has such duplicates, which setup_weather_collection.py removes first
+    collection.create_index([("place_id", pymongo.ASCENDING), ("current.last_updated_epoch", pymongo.ASCENDING)], unique=True, name="place_id_last_updated_epoch")
+
+
+
+def get_mongo_client():
+    # Connect once per container, then reuse the connection pool in the next invocations
+    global mongo_client
+    if mongo_client is None:
+        mongo_client = pymongo.MongoClient(os.getenv("MONGO_CONNECTION_STRING"), serverSelectionTimeoutMS=mongo_server_selection_timeout_ms)
+    return mongo_client
+
+
+
+def get_collection():
+    # Create the indexes once per container
+    global weather_collection
+    if weather_collection is None:
+        collection = get_mongo_client()[os.getenv("MONGO_DB_NAME")][os.getenv("MONGO_WEATHER_COLLECTION_NAME")]
+        # The deterministic ids keep the inserts idempotent without the indexes, so a failure to build them must not stop the inserts
+        try:
+            create_indexes(collection)
+        except pymongo.errors.OperationFailure as e:
+            logger.error(f"Failed to create the indexes of the weather collection, run setup_weather_collection.py to remove the duplicates. Error message: \"{e}\". {format_traceback()}.")
         logger.info("Successfully connected to MongoDB")
-        collection = client[database_name][collection_name]
-        # Insert data into MongoDB
-        logger.info(f"Start inserting {len(weather_data)} documents")
-        inserted_documents = weather_data
+        weather_collection = collection
+    return weather_collection
+
+
+
+# Insert weather data into MongoDB in chunks while the rest of the data is still being fetched
+class WeatherDataInserter:
+    def __init__(self):
+        self.chunk_size = insert_chunk_size
+        self.max_retries = insert_max_retries
+        self.chunk = []
+        self.failed_documents = []
+        self.inserted_count = 0
+        self.error_messages = []
+        self.lock = threading.Lock()
+        # A single worker keeps one chunk in flight at a time, in the order the chunks are made
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Connect to MongoDB on the worker, so it happens while the first data is being fetched
+        self.collection = None
+        self.executor.submit(self.connect)
+
+    def connect(self):
         try:
-            collection.insert_many(inserted_documents, ordered=False)
-            logger.info(f"Successfully inserted all weather data")
+            self.collection = get_collection()
+        except pymongo.errors.ServerSelectionTimeoutError as timeout_e:
+            message = f"Failed to connect to MongoDB.\nError message: \"{timeout_e}\"."
+            logger.error(f"{message} {format_traceback()}.")
+            self.error_messages.append(message)
         except Exception as e:
-            message = f"Failed to insert weather data. An unexpected error occurred: \"{e}\"."
+            message = f"Something is wrong. Error message: \"{e}\"."
             logger.error(f"{message} {format_traceback()}.")
-            notify_error(session, message)
-            save_to_s3(session, weather_data)
-    except pymongo.errors.ServerSelectionTimeoutError as timeout_e:
-        message = f"Failed to connect to MongoDB.\nError message: \"{timeout_e}\"."
-        logger.error(f"{message} {format_traceback()}.")
-        notify_error(session, message)
-        save_to_s3(session, weather_data)
-    except Exception as e:
-        message = f"Something is wrong. Error message: \"{e}\"."
-        logger.error(f"{message} {format_traceback()}.")
-        notify_error(session, message)
-        save_to_s3(session, weather_data)
+            self.error_messages.append(message)
 
+    def run_in_background(self, function):
+        # Run a task on the worker after the connection, skipping it if MongoDB cannot be reached
+        self.executor.submit(lambda: function() if self.collection is not None else None)
 
+    def add(self, document):
+        self.chunk.append(document)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
 
-def handler(event=None, context=None):
-    # Load environment variables
-    load_dotenv()
+    def flush(self):
+        if len(self.chunk) == 0:
+            return
+        chunk = self.chunk
+        self.chunk = []
+        self.executor.submit(self.insert_chunk, chunk)
+
+    def insert_chunk(self, documents):
+        # Nothing checks the future of a chunk, so any error left here would lose its documents: save them to S3 instead
+        try:
+            self.upsert_chunk(documents)
+        except Exception as e:
+            message = f"Failed to insert weather data. An unexpected error occurred: \"{e}\"."
+            logger.error(f"{message} {format_traceback()}. {len(documents)} document(s) will be saved to S3.")
+            with self.lock:
+                self.failed_documents.extend(documents)
+                self.error_messages.append(message)
+
+    def upsert_chunk(self, documents):
+        # The chunks run after connect on the same worker, so a failed connection is known by then
+        if self.collection is None:
+            with self.lock:
+                self.failed_documents.extend(documents)
+            return
+        # Retry only the documents which failed, and keep the ones which still fail after the last retry
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Upsert by the deterministic id, so a document which already exists is left as it is
+                operations = [pymongo.UpdateOne({"_id": get_document_id(document)}, {"$setOnInsert": to_stored_document(document)}, upsert=True) for document in documents]
+                with metrics.timer("mongo_insert_seconds"):
+                    result = self.collection.bulk_write(operations, ordered=False)
+                self.inserted_count += result.upserted_count
+                metrics.increment("mongo_inserted_documents", result.upserted_count)
+                metrics.observe("mongo_insert_chunk_size", len(documents))
+                return
+            except pymongo.errors.BulkWriteError as e:
+                self.inserted_count += e.details.get("nUpserted", 0)
+                metrics.increment("mongo_inserted_documents", e.details.get("nUpserted", 0))
+                # A duplicate key error means the document has already been inserted
+                write_errors = [error for error in e.details.get("writeErrors", []) if error["code"] != 11000]
+                write_concern_errors = e.details.get("writeConcernErrors", [])
+                failed_indexes = {error["index"] for error in write_errors}
+                # A write concern error does not say which writes are durable, so retry them all: the upserts leave existing documents as they are
+                if len(write_concern_errors) != 0:
+                    failed_indexes = set(range(len(documents)))
+                errors = [error["errmsg"] for error in write_errors + write_concern_errors]
+                message = f"Failed to insert {len(failed_indexes)} of {len(documents)} weather documents. Error: \"{errors[0] if len(errors) != 0 else e}\"."
+                documents = [document for index, document in enumerate(documents) if index in failed_indexes]
+                if len(documents) == 0:
+                    return
+            except Exception as e:
+                message = f"Failed to insert weather data. An unexpected error occurred: \"{e}\"."
+            logger.warning(f"{message} Attempt {attempt + 1} of {self.max_retries + 1}.")
+        logger.error(f"{message} {len(documents)} document(s) will be saved to S3.")
+        metrics.increment("mongo_failed_documents", len(documents))
+        with self.lock:
+            self.failed_documents.extend(documents)
+            self.error_messages.append(message)
+
+    def close(self):
+        # Wait for the last chunks, then save what could not be inserted to S3
+        self.flush()
+        self.executor.shutdown(wait=True)
+        logger.info(f"Inserted {self.inserted_count} weather documents")
+        if len(self.error_messages) != 0 or len(self.failed_documents) != 0:
+            session = create_session()
+            notify_error(session, " ".join(self.error_messages))
+            if len(self.failed_documents) != 0:
+                save_to_s3(session, self.failed_documents)
 
+
+
+def insert_weather_data(weather_data=None):
+    inserter = WeatherDataInserter()
+    logger.info(f"Start inserting {len(weather_data)} documents")
+    for document in weather_data:
+        inserter.add(document)
+    inserter.close()
+
+
+
+def handler(event=None, context=None):
     # Assign expected_last_updated value for later use
     global expected_last_updated
     expected_last_updated = (datetime.utcnow() + timedelta(hours=7)).replace(minute=0, second=0, microsecond=0)
 
-    # Load data for place_coordinates variable
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    all_files_and_directories = os.listdir(script_dir)
-    directories = [name for name in all_files_and_directories if os.path.isdir(os.path.join(script_dir, name))]
-    if "data" in directories:
-        file_path = os.path.join(script_dir, 'data/place_coordinates.json')
-    else:
-        file_path = os.path.join(script_dir, '../data/place_coordinates.json')
-    with open(file_path, 'r') as f:
-        place_coordinates = json.load(f)
-
-    # Set up logging
-    global logger
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    
-    # Call the functions
-    weather_data = get_weather_data(place_coordinates)
-    insert_weather_data(weather_data)
\ No newline at end of file
+    # Load data for place_coordinates variable, with the places added before the last invocation
+    place_coordinates = load_place_coordinates()
+
+    # Stop fetching early enough to leave time for inserting the data
+    time_budget = context.get_remaining_time_in_millis() / 1000 if context is not None else fetch_time_budget
+    deadline = time.monotonic() + time_budget - insert_time_reserve
+
+    # Only fetch the places a previous run of the same hour handed off, if asked to
+    place_states = None
+    if event is not None and event.get("resume_pending_places") == True:
+        place_states = load_pending_places(create_session())
+        if place_states is not None:
+            place_coordinates = {place_id: state["coordinate"] for place_id, state in place_states.items()}
+
+    # Call the functions, inserting the data while it is being fetched
+    inserter = WeatherDataInserter()
+    inserter.run_in_background(refresh_place_registry)
+    _, pending_places = get_weather_data(place_coordinates, deadline, place_states, sink=inserter.add)
+    inserter.close()
+    if len(pending_places) != 0:
+        save_pending_places(create_session(), pending_places)
\ No newline at end of file
@@ -0,0 +1,150 @@
+import os
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# Choose where the metrics go: "none" (default), "statsd" or "prometheus"
+exporter_name = os.getenv("METRICS_EXPORTER", "none").lower()
+# The upper bounds of the histogram buckets, which cover both durations in seconds and batch sizes
+histogram_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 1000, 10000]
+exporter = None
+exporter_lock = threading.Lock()
+
+
+
+class NoOpExporter:
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+
+
+# Send every measurement to a statsd server over UDP
+# A standard statsd server only knows timers, in milliseconds, and no tags, so the labels are added to the name
+# A DogStatsD server (flavor "dogstatsd") gets histograms in the units they are measured in, with the labels as tags
+class StatsdExporter:
+    def __init__(self, host, port, prefix, flavor="statsd"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.flavor = flavor
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, metric_type, labels):
+        tags = ""
+        if self.flavor == "dogstatsd":
+            tags = "|#" + ",".join(f"{key}:{label}" for key, label in labels) if len(labels) != 0 else ""
+        else:
+            name += "".join(f".{label}" for _, label in labels)
+        try:
+            self.socket.sendto(f"{self.prefix}{name}:{value}|{metric_type}{tags}".encode(), self.address)
+        except OSError:
+            # Metrics must never break the pipeline
+            pass
+
+    def increment(self, name, value, labels):
+        self.send(name, value, "c", labels)
+
+    def observe(self, name, value, labels):
+        if self.flavor == "dogstatsd":
+            self.send(name, value, "h", labels)
+        elif name.endswith("_seconds"):
+            self.send(name[:-len("_seconds")] + "_ms", round(value * 1000, 3), "ms", labels)
+        else:
+            # Sizes are sent as timers too, which is the only metric type of statsd with percentiles
+            self.send(name, value, "ms", labels)
+
+
+
+# Keep the metrics in memory and serve them in the Prometheus text format
+class PrometheusExporter:
+    def __init__(self, port):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+
+    def increment(self, name, value, labels):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, labels), {"buckets": [0] * len(histogram_buckets), "sum": 0, "count": 0})
+            for index, bucket in enumerate(histogram_buckets):
+                if value <= bucket:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{key}="{label}"' for key, label in pairs) + "}" if len(pairs) != 0 else ""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}_total{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bucket, count in zip(histogram_buckets, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bucket)])} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+
+def get_exporter():
+    # Create the exporter on first use, so importing this module has no side effects
+    global exporter
+    with exporter_lock:
+        if exporter is None:
+            if exporter_name == "statsd":
+                exporter = StatsdExporter(os.getenv("STATSD_HOST", "localhost"), int(os.getenv("STATSD_PORT", 8125)), os.getenv("STATSD_PREFIX", "weather."), os.getenv("STATSD_FLAVOR", "statsd").lower())
+            elif exporter_name == "prometheus":
+                exporter = PrometheusExporter(int(os.getenv("METRICS_PORT", 9108)))
+            else:
+                exporter = NoOpExporter()
+        return exporter
+
+
+
+def increment(name, value=1, **labels):
+    get_exporter().increment(name, value, tuple(sorted(labels.items())))
+
+
+
+def observe(name, value, **labels):
+    get_exporter().observe(name, value, tuple(sorted(labels.items())))
+
+
+
+@contextmanager
+def timer(name, **labels):
+    # Observe how long the block took, in seconds
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started_at, **labels)
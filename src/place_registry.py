@@ -0,0 +1,147 @@
+import os
+import math
+import json
+import time
+import logging
+import threading
+import pymongo
+from bson import json_util
+
+
+
+# Set up the registry of places, which keeps the coordinates of the places collection in memory
+# It starts from a snapshot file written by extract_coordinates.py, then only reads the places added or updated since from MongoDB
+snapshot_file_name = "place_registry.json"
+refresh_interval = float(os.getenv("PLACE_REGISTRY_REFRESH_SECONDS", 60))
+grid_cell_degrees = float(os.getenv("PLACE_GRID_CELL_DEGREES", 0.5))
+
+
+
+def parse_coordinate(value):
+    # The places API gives coordinates like '10.58333N' or '107.25E', where S and W are negative
+    if isinstance(value, str):
+        if value[-1] in "NSEW":
+            return -float(value[:-1]) if value[-1] in "SW" else float(value[:-1])
+        return float(value)
+    return float(value)
+
+
+
+# An immutable version of the registry, which callers can keep while the registry is refreshed
+class PlaceSnapshot:
+    def __init__(self, version, coordinates, last_id=None, last_updated_at=None):
+        self.version = version
+        self.coordinates = coordinates
+        # The position of the incremental cursor: the largest _id and updated_at read so far
+        self.last_id = last_id
+        self.last_updated_at = last_updated_at
+        # Group the places by cell of a grid, so the nearest place is found without comparing every place
+        self.grid = {}
+        for place_id, coordinate in coordinates.items():
+            self.grid.setdefault(self.get_cell(coordinate["lat"], coordinate["lon"]), []).append(place_id)
+
+    def get_cell(self, lat, lon):
+        return math.floor(lat / grid_cell_degrees), math.floor(lon / grid_cell_degrees)
+
+    def get_distance(self, lat, lon, place_id):
+        # Distance in degrees of latitude, with longitude scaled to the latitude, which is accurate enough at this scale
+        coordinate = self.coordinates[place_id]
+        return math.hypot(coordinate["lat"] - lat, (coordinate["lon"] - lon) * math.cos(math.radians(lat)))
+
+    def nearest(self, lat, lon):
+        # Search the rings of cells around the cell of the point until no closer place can be in the next ring
+        if len(self.coordinates) == 0:
+            return None
+        cell_lat, cell_lon = self.get_cell(lat, lon)
+        max_ring = max(max(abs(cell[0] - cell_lat), abs(cell[1] - cell_lon)) for cell in self.grid)
+        nearest_place_id = None
+        nearest_distance = None
+        for ring in range(max_ring + 1):
+            for d_lat in range(-ring, ring + 1):
+                for d_lon in range(-ring, ring + 1):
+                    if max(abs(d_lat), abs(d_lon)) != ring:
+                        continue
+                    for place_id in self.grid.get((cell_lat + d_lat, cell_lon + d_lon), []):
+                        distance = self.get_distance(lat, lon, place_id)
+                        if nearest_distance is None or distance < nearest_distance:
+                            nearest_place_id = place_id
+                            nearest_distance = distance
+            # The places of the next ring are at least this far away
+            if nearest_distance is not None and nearest_distance <= ring * grid_cell_degrees * math.cos(math.radians(lat)):
+                break
+        return nearest_place_id
+
+
+
+class PlaceRegistry:
+    def __init__(self, collection=None):
+        # collection is the places collection, without it the registry only serves its snapshot
+        self.collection = collection
+        self.snapshot = PlaceSnapshot(0, {})
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def load(self, data_dir):
+        # Load the snapshot written by extract_coordinates.py, or place_coordinates.json without a cursor (read everything on the next refresh)
+        snapshot_file_path = os.path.join(data_dir, snapshot_file_name)
+        if os.path.exists(snapshot_file_path):
+            # Extended JSON keeps the types of the cursor (an ObjectId and a date)
+            with open(snapshot_file_path, "r") as f:
+                state = json_util.loads(f.read())
+            self.snapshot = PlaceSnapshot(state["version"], state["coordinates"], state["last_id"], state["last_updated_at"])
+        elif os.path.exists(os.path.join(data_dir, "place_coordinates.json")):
+            with open(os.path.join(data_dir, "place_coordinates.json"), "r") as f:
+                self.snapshot = PlaceSnapshot(0, json.load(f))
+        logging.info(f"Loaded version {self.snapshot.version} of the place registry with {len(self.snapshot.coordinates)} place(s)")
+        return self.snapshot
+
+    def save(self, data_dir):
+        snapshot = self.snapshot
+        snapshot_file_path = os.path.join(data_dir, snapshot_file_name)
+        temporary_file_path = snapshot_file_path + ".tmp"
+        with open(temporary_file_path, "w") as f:
+            f.write(json_util.dumps({"version": snapshot.version, "coordinates": snapshot.coordinates, "last_id": snapshot.last_id, "last_updated_at": snapshot.last_updated_at}))
+        os.replace(temporary_file_path, snapshot_file_path)
+
+    def refresh(self, force=False):
+        # Read the places added (larger _id) or updated (larger updated_at) since the snapshot, at most once per interval unless forced
+        # Places removed from the collection stay until extract_coordinates.py writes a new snapshot
+        if self.collection is None:
+            return self.snapshot
+        with self.lock:
+            if not force and self.refreshed_at is not None and time.monotonic() - self.refreshed_at < refresh_interval:
+                return self.snapshot
+            snapshot = self.snapshot
+            conditions = []
+            if snapshot.last_id is not None:
+                conditions.append({"_id": {"$gt": snapshot.last_id}})
+            if snapshot.last_updated_at is not None:
+                conditions.append({"updated_at": {"$gt": snapshot.last_updated_at}})
+            else:
+                conditions.append({"updated_at": {"$ne": None}})
+            query = {"$or": conditions} if snapshot.last_id is not None else {}
+            coordinates = None
+            last_id = snapshot.last_id
+            last_updated_at = snapshot.last_updated_at
+            for document in self.collection.find(query, {"place_id": 1, "lat": 1, "lon": 1, "updated_at": 1}):
+                if coordinates is None:
+                    coordinates = dict(snapshot.coordinates)
+                coordinates[document["place_id"]] = {"lat": parse_coordinate(document["lat"]), "lon": parse_coordinate(document["lon"])}
+                last_id = document["_id"] if last_id is None else max(last_id, document["_id"])
+                if document.get("updated_at") is not None:
+                    last_updated_at = document["updated_at"] if last_updated_at is None else max(last_updated_at, document["updated_at"])
+            self.refreshed_at = time.monotonic()
+            # Only publish a new version when something changed, so callers can compare versions
+            if coordinates is not None:
+                self.snapshot = PlaceSnapshot(snapshot.version + 1, coordinates, last_id, last_updated_at)
+                logging.info(f"Refreshed the place registry to version {self.snapshot.version} with {len(coordinates) - len(snapshot.coordinates)} new place(s)")
+            return self.snapshot
+
+
+
+def create_indexes(collection):
+    # The incremental refresh looks places up by _id and by updated_at
+    collection.create_index([("updated_at", pymongo.ASCENDING)], name="updated_at")
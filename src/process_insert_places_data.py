@@ -4,6 +4,7 @@ import pymongo
 from google.cloud import bigquery
 import os
 from dotenv import load_dotenv
+from bigquery_writer import BigQueryWriter
 
 # Set up credentials
 load_dotenv()
@@ -50,41 +51,20 @@ def check_duplicates(data):
 
 
 
-def generate_insert_statement(rows):
+# Define a function to handle inserting data to BigQuery
+def insert_data(rows):
     # Check if the unique_documents is empty
-    if not rows_to_insert:
+    if not rows:
         print("No new rows to insert")
         return
-    # Get the column names from the keys of the first row
-    columns = ', '.join(rows[0].keys())
-    # Generate a list of value strings
-    values = []
-    for row in rows:
-        value_string = ', '.join(f"'{row[column]}'" for column in list(rows[0].keys()))
-        values.append(f"    ({value_string})\n")
-
-    # Join all value strings into a single string
-    values_string = ', '.join(values)
-
-    # Generate the final INSERT statement
-    insert_statement = f"INSERT INTO `{dataset_id}.{table_id}` ({columns})\nVALUES\n{values_string};"
-
-    return insert_statement
-
-
-
-# Define a function to handle inserting data to BigQuery
-def insert_data(insert_statement):
-    bigquery_client = bigquery.Client()
-    # Insert rows into BigQuery
-    insert_job = bigquery_client.query(insert_statement)
-    insert_job.result()
-    print(f"Successfullt inserted {insert_job.num_dml_affected_rows} rows into '{dataset_id}.{table_id}' table")
+    # Insert typed rows into BigQuery, split into requests under the size limits
+    writer = BigQueryWriter(bigquery.Client(), dataset_id, table_id, "places_info")
+    inserted_count = writer.insert_rows(rows)
+    print(f"Successfully inserted {inserted_count} rows into '{dataset_id}.{table_id}' table")
 
 
 
 if __name__ == "__main__":
     places_data = get_data()
     rows_to_insert = check_duplicates(places_data)
-    insert_statement = generate_insert_statement(rows_to_insert)
-    insert_data(insert_statement)
\ No newline at end of file
+    insert_data(rows_to_insert)
\ No newline at end of file
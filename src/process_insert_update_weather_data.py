@@ -3,10 +3,21 @@
 import pymongo
 from google.cloud import bigquery
 from bson.objectid import ObjectId
+from bson import json_util
 import os
 import logging
 import traceback
-from datetime import timedelta, datetime
+import time
+import zlib
+import queue
+import signal
+import threading
+from collections import OrderedDict, deque
+from datetime import timedelta, datetime, timezone
+from transform_weather_data import process_document
+from bigquery_writer import BigQueryWriter, get_daily_summary_statement
+from place_registry import PlaceRegistry
+import metrics
 
 
 
@@ -19,12 +30,67 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 file_path = os.path.join(script_dir, f"../data/{key_file_name}")
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = file_path
 bigquery_client = bigquery.Client()
+weather_writer = BigQueryWriter(bigquery_client, dataset_id, weather_table_id, "hourly_weather_data", partition_column="last_updated")
+
+# Set up the daily summary of each place, which is recomputed for the places and days of every batch that lands
+maintain_daily_summary = os.getenv("MAINTAIN_DAILY_SUMMARY", "true").lower() == "true"
+daily_table_id = os.getenv("BIGQUERY_DAILY_TABLE_ID", f"{weather_table_id}_daily")
+
+# Set up the optional propagation of deletes
+# Deleted ids are loaded into a tombstone table and removed from the weather table periodically with one statement
+propagate_deletes = os.getenv("PROPAGATE_DELETES", "false").lower() == "true"
+tombstone_table_id = os.getenv("BIGQUERY_TOMBSTONE_TABLE_ID", f"{weather_table_id}_tombstones")
+tombstone_compaction_interval = float(os.getenv("TOMBSTONE_COMPACTION_INTERVAL_SECONDS", 3600))
+tombstone_writer = BigQueryWriter(bigquery_client, dataset_id, tombstone_table_id, "hourly_weather_data_tombstones")
+pending_tombstone_ids = set()
+tombstones_compacted_at = None
+tombstone_lock = threading.Lock()
+# The TTL of the collection (see setup_weather_collection.py), whose expirations are not deletes to propagate
+retention_seconds = None
+
+# Set up the workers which process the change events in parallel, partitioned by place_id
+transfer_worker_count = int(os.getenv("TRANSFER_WORKERS", 1))
+transfer_worker_queue_size = int(os.getenv("TRANSFER_WORKER_QUEUE_SIZE", 4))
+# A batch which still fails after the last attempt is written to the dead-letter file, so the stream moves on
+transfer_max_attempts = int(os.getenv("TRANSFER_MAX_ATTEMPTS", 3))
+transfer_retry_delay = float(os.getenv("TRANSFER_RETRY_DELAY_SECONDS", 5))
+stop_requested = False
 
 # Set up MongoDB client
 mongo_client = pymongo.MongoClient(os.getenv('MONGO_CONNECTION_STRING'))
 db = mongo_client[os.getenv('MONGO_DB_NAME')]
 collection = db[os.getenv('MONGO_WEATHER_COLLECTION_NAME')]
 
+# Documents which cannot be converted to rows are written to a dead-letter file instead of blocking the stream
+dead_letter_file_path = os.getenv("DEAD_LETTER_FILE", os.path.join(script_dir, "../data/dead_letters.jsonl"))
+dead_letter_lock = threading.Lock()
+
+# The fields of the weather documents which are transferred to BigQuery
+transferred_fields = ["_id", "place_id", "current"]
+
+# Set up the registry of the places collection, which tells whether an unknown place_id is worth reloading the places table for
+place_registry = PlaceRegistry(db[os.getenv("MONGO_PLACES_COLLECTION_NAME")]) if os.getenv("MONGO_PLACES_COLLECTION_NAME") else None
+
+# Set up batching of change events (flush by number of events or by time window)
+batch_size = int(os.getenv("TRANSFER_BATCH_SIZE", 500))
+batch_max_delay = float(os.getenv("TRANSFER_BATCH_MAX_DELAY_SECONDS", 10))
+# Set up the in-memory cache of valid place_ids (refreshed after a TTL or when an unknown place_id shows up)
+place_cache_ttl = float(os.getenv("PLACE_CACHE_TTL_SECONDS", 3600))
+unknown_place_cache_size = int(os.getenv("UNKNOWN_PLACE_CACHE_SIZE", 1000))
+valid_place_ids = set()
+place_ids_loaded_at = None
+unknown_place_ids = OrderedDict()
+place_cache_lock = threading.Lock()
+
+# Resume token (and cluster time) of the last change event whose batch has landed in BigQuery
+# They are saved to a file so the daemon can continue where it stopped after a restart
+resume_token_file_path = os.getenv("RESUME_TOKEN_FILE", os.path.join(script_dir, "../data/resume_token.json"))
+catch_up_max_hours = float(os.getenv("CATCH_UP_MAX_HOURS", 72))
+# inserted_at comes from the clock of the Lambda function, so the catch-up also covers this much before the last committed change
+catch_up_margin = timedelta(minutes=float(os.getenv("CATCH_UP_MARGIN_MINUTES", 10)))
+committed_resume_token = None
+committed_cluster_time = None
+
 # Set up logging
 # Create a custom Formatter class inheriting from logging.Formatter to get the GMT+7 timestamp
 class GMTPlus7Formatter(logging.Formatter):
@@ -46,142 +112,551 @@ def format_traceback():
 
 
 
-def check_row_existence(document_id):
-    query = f"""
-    SELECT 1 
-    FROM `{dataset_id}.{weather_table_id}` 
-    WHERE id = '{document_id}'
-    """
-    query_job = bigquery_client.query(query)
-    rows = list(query_job.result())
-    if len(rows) == 0:
-        logging.info(f"Row '{document_id}' DOES NOT EXIST in '{dataset_id}.{weather_table_id}' table")
-        return False
-    else:
-        logging.info(f"Row '{document_id}' EXISTS in '{dataset_id}.{weather_table_id}' table")
-        return True
+def check_rows_existence(document_ids, weather_writer=weather_writer, partition_range=None):
+    # Get the ids of a batch which already exist in BigQuery with one query, only reading the partitions of the batch
+    existing_ids = weather_writer.select_existing("id", document_ids, partition_range)
+    logging.info(f"{len(existing_ids)} of {len(document_ids)} row(s) EXIST in '{dataset_id}.{weather_table_id}' table")
+    return existing_ids
 
 
 
-def check_foreign_key(place_id, document_id):
+def load_place_ids():
+    # Load all place_ids of the places table, which is small and rarely changes
+    global valid_place_ids, place_ids_loaded_at
     query = f"""
-    SELECT 1 
-    FROM `{dataset_id}.{places_table_id}` 
-    WHERE place_id = '{place_id}'
+    SELECT DISTINCT place_id 
+    FROM `{dataset_id}.{places_table_id}`
     """
-    query_job = bigquery_client.query(query)
-    rows = list(query_job.result())
-    if len(rows) != 0:
-        logging.info(f"Place ID '{place_id}' of document '{document_id}' is VALID")
-        return True
-    else:
-        logging.info(f"Place ID '{place_id}' of document '{document_id}' is INVALID")
-        return False
+    with metrics.timer("bigquery_job_seconds", statement="select_places"):
+        query_job = bigquery_client.query(query)
+        valid_place_ids = {row["place_id"] for row in query_job.result()}
+    place_ids_loaded_at = time.monotonic()
+    # Only forget the invalid place_ids which have become valid, so reloads for other unknown ids keep the cache bounded
+    for place_id in [place_id for place_id in unknown_place_ids if place_id in valid_place_ids]:
+        del unknown_place_ids[place_id]
+    logging.info(f"Loaded {len(valid_place_ids)} place ID(s) from '{dataset_id}.{places_table_id}' table")
 
 
 
-def process_document(document):
-    document["id"] = str(document["_id"])
-    del document["_id"]
-    del document["location"]
-    for key in document["current"]:
-        document[key] = document["current"][key]
-    del document["current"]
-    document["condition"] = document["condition"]["text"]
-    document["is_day"] = bool(document["is_day"])
-    logging.info(f"Processed document '{document['id']}'")
-    return document
+def check_foreign_keys(place_ids):
+    # Get the place_ids of a batch which exist in the places table, using the cached place_ids
+    with place_cache_lock:
+        if place_ids_loaded_at is None or time.monotonic() - place_ids_loaded_at >= place_cache_ttl:
+            load_place_ids()
+        # Reload once if there are place_ids which are neither cached as valid nor known to be invalid
+        # The places table is copied from the places collection, so it is not reloaded for place_ids the collection does not have either
+        unknown_ids = [place_id for place_id in place_ids if place_id not in valid_place_ids and place_id not in unknown_place_ids]
+        if len(unknown_ids) != 0 and place_registry is not None:
+            place_coordinates = place_registry.refresh(force=True).coordinates
+            if not any(place_id in place_coordinates for place_id in unknown_ids):
+                logging.info(f"{len(unknown_ids)} place ID(s) are not in the places collection either")
+                for place_id in unknown_ids:
+                    unknown_place_ids[place_id] = True
+                    if len(unknown_place_ids) > unknown_place_cache_size:
+                        unknown_place_ids.popitem(last=False)
+                unknown_ids = []
+        if len(unknown_ids) != 0:
+            load_place_ids()
+            for place_id in unknown_ids:
+                if place_id not in valid_place_ids:
+                    unknown_place_ids[place_id] = True
+                    if len(unknown_place_ids) > unknown_place_cache_size:
+                        unknown_place_ids.popitem(last=False)
+        checked_ids = {place_id for place_id in place_ids if place_id in valid_place_ids}
+    logging.info(f"{len(checked_ids)} of {len(place_ids)} place ID(s) are VALID")
+    return checked_ids
 
 
 
-def insert_row(document, skip_existence_check=False):
-    # Check if the document already exists in BigQuery
-    if skip_existence_check == False:
-        if check_row_existence(str(document["_id"])) == True:
-            logging.info(f"Skipped document '{str(document['_id'])}'")
-            return
-    # Check if the place_id of the document is valid
-    if check_foreign_key(document["place_id"], str(document["_id"])) == False:
-        logging.info(f"Skipped document '{str(document['_id'])}'")
+def validate_rows(rows, weather_writer=weather_writer):
+    # Give each row of a batch a verdict: whether it already exists and whether its place_id is valid
+    # The hour of a reading never changes, so an existing row is in the same partition as the new one
+    partition_range = weather_writer.get_partition_range(row["last_updated"] for row in rows)
+    existing_ids = check_rows_existence(list({row["id"] for row in rows}), weather_writer, partition_range)
+    valid_place_ids = check_foreign_keys(list({row["place_id"] for row in rows}))
+    verdicts = {}
+    for row in rows:
+        verdicts[row["id"]] = {
+            "exists": row["id"] in existing_ids,
+            "valid_place": row["place_id"] in valid_place_ids
+        }
+    return verdicts
+
+
+
+def insert_rows(rows, weather_writer=weather_writer):
+    # Load all rows of a batch with load jobs instead of one INSERT statement per row
+    if len(rows) == 0:
         return
-    # Process the document
-    processed_document = process_document(document)
-    # Insert the processed document into BigQuery
-    columns = ', '.join(processed_document.keys())
-    values = ', '.join(
-        f"TIMESTAMP '{value}:00'" if key == 'last_updated' else 
-        f"'{value}'" if isinstance(value, str) else
-        f"{str(value).lower()}" if isinstance(value, bool) else
-        f"{value}" for key, value in processed_document.items()
-    )
-    insert_statement = f"""
-    INSERT INTO `{dataset_id}.{weather_table_id}` ({columns})
-    VALUES ({values})
-    """
-    logging.info(f"Start inserting row '{processed_document['id']}' into BigQuery")
-    try:
-        insert_job = bigquery_client.query(insert_statement)
-        insert_job.result()
-        logging.info(f"Successfully inserted row '{processed_document['id']}'")
-    except Exception as e:
-        logging.warning(f"Failed to insert row '{processed_document['id']}'. {format_traceback()}.")
+    logging.info(f"Start inserting {len(rows)} row(s) into BigQuery")
+    inserted_count = weather_writer.insert_rows(rows)
+    logging.info(f"Successfully inserted {inserted_count} row(s)")
+
+
+
+def merge_rows(rows, weather_writer=weather_writer):
+    # Apply all updates of a batch with one MERGE statement, which also inserts the rows that do not exist yet
+    if len(rows) == 0:
+        return
+    logging.info(f"Start merging {len(rows)} updated row(s) into BigQuery")
+    merged_count = weather_writer.merge_rows(rows, "id", weather_writer.get_partition_range(row["last_updated"] for row in rows))
+    logging.info(f"Successfully merged {merged_count} row(s)")
 
 
 
-def update_row(document_id):
-    # Check if the document already exists in BigQuery
-    if check_row_existence(document_id) == False:
-        document = collection.find_one(document_id)
-        insert_row(document, skip_existence_check=True)
+def update_daily_summary(rows, weather_writer=weather_writer):
+    # Recompute the daily summary of the places and days of the rows of a batch
+    if not maintain_daily_summary or len(rows) == 0:
         return
-    # Get the document from MongoDB
-    document = collection.find_one({"_id": ObjectId(document_id)})
-    # Check if the place_id of the document is valid
-    if check_foreign_key(document["place_id"], str(document["_id"])) == False:
-        logging.info(f"Skipped document '{str(document['_id'])}'")
+    partition_range = weather_writer.get_partition_range(row["last_updated"] for row in rows)
+    place_ids = sorted({row["place_id"] for row in rows})
+    query_parameters = [
+        bigquery.ScalarQueryParameter("start", "TIMESTAMP", partition_range[0]),
+        bigquery.ScalarQueryParameter("end", "TIMESTAMP", partition_range[1]),
+        bigquery.ArrayQueryParameter("place_ids", "STRING", place_ids)
+    ]
+    summary_statement = get_daily_summary_statement(weather_writer.table, f"{dataset_id}.{daily_table_id}", "@start", "@end", "@place_ids")
+    with metrics.timer("bigquery_job_seconds", statement="summary"):
+        summary_job = weather_writer.client.query(summary_statement, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+        summary_job.result()
+    logging.info(f"Updated the daily summary of {len(place_ids)} place(s) in '{dataset_id}.{daily_table_id}' table")
+
+
+
+def write_tombstones(tombstones, tombstone_writer=tombstone_writer):
+    if len(tombstones) == 0:
         return
-    # Process the document
-    processed_document = process_document(document)
-    # Update the document in BigQuery
-    set_clause = ', '.join(
-        f"{key} = TIMESTAMP('{value}:00')" if key == 'last_updated' else 
-        f"{key} = '{value}'" if isinstance(value, str) else 
-        f"{key} = {value}" for key, value in processed_document.items()
-    )
-    update_statement = f"""
-    UPDATE `{dataset_id}.{weather_table_id}`
-    SET {set_clause}
-    WHERE id = '{document_id}'
+    # Tombstones are never written while they are being compacted
+    with tombstone_lock:
+        tombstone_writer.insert_rows(tombstones)
+        pending_tombstone_ids.update(tombstone["id"] for tombstone in tombstones)
+    logging.info(f"Recorded {len(tombstones)} deleted row(s) in '{dataset_id}.{tombstone_table_id}' table")
+
+
+
+def compact_tombstones():
+    # Delete the rows of all recorded tombstones from the weather table, then clear those tombstones
+    # The rows are looked up in the partitions of the days of the tombstones, with a day before as a margin for older ids generated after the reading
+    # Tombstones recorded before they had last_updated fall back to the whole table
+    # The places and days of the deleted rows are kept first, so their daily summary can be recomputed
+    global tombstones_compacted_at
+    query_parameters = [bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", datetime.now(timezone.utc))]
+    delete_statement = f"""
+    DECLARE scan_start TIMESTAMP;
+    DECLARE scan_end TIMESTAMP;
+    DECLARE deleted_start TIMESTAMP;
+    DECLARE deleted_end TIMESTAMP;
+    DECLARE deleted_place_ids ARRAY<STRING>;
+    CREATE TEMP TABLE compacted_tombstones AS
+    SELECT id, last_updated FROM `{dataset_id}.{tombstone_table_id}` WHERE recorded_at <= @cutoff;
+    SET (scan_start, scan_end) = (
+        SELECT AS STRUCT
+            IF(COUNTIF(last_updated IS NULL) = 0, TIMESTAMP_SUB(TIMESTAMP_TRUNC(MIN(last_updated), DAY), INTERVAL 1 DAY), TIMESTAMP '1970-01-01'),
+            IF(COUNTIF(last_updated IS NULL) = 0, TIMESTAMP_ADD(TIMESTAMP_TRUNC(MAX(last_updated), DAY), INTERVAL 1 DAY), TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 1 DAY))
+        FROM compacted_tombstones
+    );
+    CREATE TEMP TABLE deleted_rows AS
+    SELECT place_id, last_updated FROM `{dataset_id}.{weather_table_id}`
+    WHERE last_updated >= scan_start AND last_updated < scan_end
+    AND id IN (SELECT id FROM compacted_tombstones);
+    SET (deleted_start, deleted_end, deleted_place_ids) = (
+        SELECT AS STRUCT TIMESTAMP_TRUNC(MIN(last_updated), DAY), TIMESTAMP_ADD(TIMESTAMP_TRUNC(MAX(last_updated), DAY), INTERVAL 1 DAY), ARRAY_AGG(DISTINCT place_id)
+        FROM deleted_rows
+    );
+    DELETE FROM `{dataset_id}.{weather_table_id}`
+    WHERE last_updated >= deleted_start AND last_updated < deleted_end
+    AND id IN (SELECT id FROM compacted_tombstones);
+    DELETE FROM `{dataset_id}.{tombstone_table_id}`
+    WHERE recorded_at <= @cutoff;
     """
-    logging.info(f"Start updating row '{document_id}'")
+    if maintain_daily_summary:
+        delete_statement += get_daily_summary_statement(f"{dataset_id}.{weather_table_id}", f"{dataset_id}.{daily_table_id}", "deleted_start", "deleted_end", "deleted_place_ids") + ";\n"
+    with tombstone_lock:
+        with metrics.timer("bigquery_job_seconds", statement="delete"):
+            delete_job = bigquery_client.query(delete_statement, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+            delete_job.result()
+        pending_tombstone_ids.clear()
+        tombstones_compacted_at = time.monotonic()
+    logging.info(f"Compacted the tombstones of '{dataset_id}.{weather_table_id}' table")
+
+
+
+def load_retention():
+    global retention_seconds
+    for index in collection.index_information().values():
+        if "expireAfterSeconds" in index:
+            retention_seconds = index["expireAfterSeconds"]
+            logging.info(f"Documents older than {retention_seconds} second(s) expire, and their deletes are not propagated")
+
+
+
+def is_expired(change):
+    # A delete of a document as old as the TTL is an expiration, so its row stays in BigQuery
+    # The id of a document is at most an hour younger than its reading, so that hour is given as a margin
+    if retention_seconds is None:
+        return False
+    age = change["clusterTime"].as_datetime() - change["documentKey"]["_id"].generation_time
+    return age >= timedelta(seconds=retention_seconds - 3600)
+
+
+
+def get_tombstone_last_updated(change):
+    # A delete has no document, but the _id of a weather document holds the epoch of its reading
+    # The weather table stores the local time of the places (UTC+7) in last_updated, so the epoch is shifted the same way
+    return change["documentKey"]["_id"].generation_time + timedelta(hours=7)
+
+
+
+def changes_transferred_fields(change):
+    # An update which only changes other fields (like the migration of setup_weather_collection.py) has nothing to transfer
+    update_description = change.get("updateDescription")
+    if change["operationType"] != "update" or update_description is None:
+        return True
+    changed_fields = list(update_description.get("updatedFields", {})) + list(update_description.get("removedFields", []))
+    return any(field.split(".")[0] in transferred_fields for field in changed_fields)
+
+
+
+def write_dead_letters(records):
+    # Append one JSON line per record, to be inspected and replayed by hand
+    with dead_letter_lock:
+        with open(dead_letter_file_path, "a") as f:
+            for record in records:
+                f.write(json_util.dumps(record) + "\n")
+    metrics.increment("transfer_dead_letters", len(records))
+    logging.error(f"Wrote {len(records)} record(s) to the dead-letter file {dead_letter_file_path}")
+
+
+
+def convert_documents(documents, weather_writer=weather_writer):
+    # Convert the documents one at a time, so a single bad document is set aside instead of failing the whole batch
+    rows = []
+    dead_letters = []
+    for document in documents:
+        try:
+            # process_document only changes the top level of the document, so the original stays intact for the dead letter
+            row = process_document(dict(document))
+            weather_writer.validate_row(row)
+            rows.append(row)
+        except Exception as e:
+            logging.warning(f"Failed to convert document '{document.get('_id')}'. Error message: \"{e}\"")
+            dead_letters.append({"error": str(e), "document": document})
+    if len(dead_letters) != 0:
+        write_dead_letters(dead_letters)
+    return rows
+
+
+
+def flush_batch(batch, weather_writer=weather_writer, tombstone_writer=tombstone_writer):
+    # Collapse the changes of each document in the batch to the last one
+    last_changes = {}
+    changed_earlier = set()
+    for change in batch:
+        if not changes_transferred_fields(change):
+            continue
+        document_id = str(change["documentKey"]["_id"])
+        if document_id in last_changes:
+            changed_earlier.add(document_id)
+        last_changes[document_id] = change
+    # A document inserted after other changes in the batch (deleted then inserted again) may already have a row, so it is merged like an update
+    inserted_documents = []
+    updated_documents = []
+    tombstones = []
+    for document_id, change in last_changes.items():
+        if change["operationType"] == "insert" and document_id not in changed_earlier:
+            inserted_documents.append(change["fullDocument"])
+        elif change["operationType"] in ["insert", "update", "replace"]:
+            if change.get("fullDocument") is None:
+                logging.info(f"Skipped document '{document_id}' which no longer exists")
+                continue
+            updated_documents.append(change["fullDocument"])
+        elif change["operationType"] == "delete" and propagate_deletes and not is_expired(change):
+            tombstones.append({"id": document_id, "last_updated": get_tombstone_last_updated(change), "deleted_at": change["clusterTime"].as_datetime(), "recorded_at": datetime.now(timezone.utc)})
+    # Convert the documents first, so a document which cannot be converted is set aside before it reaches the lookups
+    inserted_rows = convert_documents(inserted_documents, weather_writer)
+    updated_rows = convert_documents(updated_documents, weather_writer)
+    # A document which comes back after being deleted must not be removed by an older tombstone
+    if len(pending_tombstone_ids) != 0 and any(row["id"] in pending_tombstone_ids for row in inserted_rows + updated_rows):
+        compact_tombstones()
+    # Validate the whole batch at once
+    verdicts = validate_rows(inserted_rows + updated_rows, weather_writer)
+    # Inserted rows are skipped if they already exist or their place_id is invalid
+    rows = []
+    for row in inserted_rows:
+        if verdicts[row["id"]]["exists"] or not verdicts[row["id"]]["valid_place"]:
+            logging.info(f"Skipped document '{row['id']}'")
+            continue
+        rows.append(row)
+    # Updated rows are skipped if their place_id is invalid, and merged otherwise
+    rows_to_merge = []
+    for row in updated_rows:
+        if not verdicts[row["id"]]["valid_place"]:
+            logging.info(f"Skipped document '{row['id']}'")
+            continue
+        rows_to_merge.append(row)
+    insert_rows(rows, weather_writer)
+    merge_rows(rows_to_merge, weather_writer)
+    # The summary covers the rows skipped as existing too: a retry after a failed summary finds them loaded, and the recompute is idempotent
+    update_daily_summary([row for row in inserted_rows + updated_rows if verdicts[row["id"]]["valid_place"]], weather_writer)
+    write_tombstones(tombstones, tombstone_writer)
+    logging.info(f"Flushed a batch of {len(batch)} change event(s)")
+
+
+
+def load_resume_token():
+    global committed_resume_token, committed_cluster_time
+    if not os.path.exists(resume_token_file_path):
+        logging.info("No saved resume token was found. Watching for new changes only")
+        return
+    with open(resume_token_file_path, "r") as f:
+        saved_state = json_util.loads(f.read(), json_options=json_util.JSONOptions(tz_aware=True))
+    committed_resume_token = saved_state["resume_token"]
+    committed_cluster_time = saved_state["cluster_time"]
+    logging.info(f"Loaded the resume token of the change committed at {committed_cluster_time}")
+
+
+
+def commit_resume_token(resume_token, cluster_time):
+    # Save the resume point to a temporary file first so a crash never leaves a half-written file
+    global committed_resume_token, committed_cluster_time
+    committed_resume_token = resume_token
+    committed_cluster_time = cluster_time
+    temporary_file_path = resume_token_file_path + ".tmp"
+    with open(temporary_file_path, "w") as f:
+        f.write(json_util.dumps({"resume_token": resume_token, "cluster_time": cluster_time}))
+    os.replace(temporary_file_path, resume_token_file_path)
+
+
+
+def catch_up(since):
+    # Replay the documents inserted since the last committed change as inserts
+    # The _id of a document holds the time of its reading, not of its insert, so the scan is on inserted_at
+    # Documents written before inserted_at existed are found by _id instead
+    # The scan is bounded by CATCH_UP_MAX_HOURS, and rows which already exist are skipped by the validation
+    earliest = datetime.now(timezone.utc) - timedelta(hours=catch_up_max_hours)
+    start = max(since - catch_up_margin, earliest)
+    logging.info(f"Start catching up on documents inserted since {start}")
+    query = {"$or": [{"inserted_at": {"$gte": start}}, {"inserted_at": {"$exists": False}, "_id": {"$gte": ObjectId.from_datetime(start)}}]}
+    batch = []
+    for document in collection.find(query).batch_size(batch_size):
+        batch.append({"operationType": "insert", "documentKey": {"_id": document["_id"]}, "fullDocument": document})
+        if len(batch) >= batch_size:
+            flush_batch(batch)
+            batch = []
+    if len(batch) != 0:
+        flush_batch(batch)
+    logging.info("Finished catching up")
+
+
+
+def open_stream():
+    # start_after (unlike resume_after) can also continue after an invalidate event
     try:
-        update_job = bigquery_client.query(update_statement)
-        update_job.result()
-        logging.info(f"Successfully updated row '{document_id}'")
-    except Exception as e:
-        logging.warning(f"Failed to update row '{document_id}'. {format_traceback()}.")
+        return collection.watch(full_document="updateLookup", start_after=committed_resume_token, max_await_time_ms=1000)
+    except pymongo.errors.OperationFailure as e:
+        # 280 and 286 mean that the resume token is no longer in the oplog
+        if committed_resume_token is None or e.code not in (280, 286):
+            raise
+        logging.warning(f"The saved resume token has expired. Error message: \"{e}\"")
+        # Open the new stream before the catch-up scan so that no change falls in between
+        stream = collection.watch(full_document="updateLookup", max_await_time_ms=1000)
+        catch_up(committed_cluster_time)
+        return stream
 
 
 
 # Watch the MongoDB collection for changes and call suitable functions
-unexpected_operation_message = ""
-with collection.watch() as stream:
-    logging.info("Watching for changes...")
-    for change in stream:
-        operation_type = change["operationType"]
-        coll_id = "'" + change["ns"]["db"] + "." + change["ns"]["coll"] + "'"
-        if operation_type == "insert":
-            full_document = change['fullDocument']
-            logging.info(f"Document '{str(full_document['_id'])}' was INSERTED into {coll_id}")
-            insert_row(full_document)
-        elif operation_type == "update":
-            document_key = str(change['documentKey']['_id'])
-            logging.info(f"Document '{document_key}' was UPDATED in {coll_id}")
-            update_row(document_key)
-        elif operation_type == "delete":
-            document_key = str(change['documentKey']['_id'])
-            logging.info(f"Document '{document_key}' was DELETED from {coll_id}")
-        else:
-            unexpected_operation_message = f"An unexpected operation was performed (operationType:{operation_type}). Change details: {change}"
-            logging.error(unexpected_operation_message)
-            os._exit(1)
\ No newline at end of file
+# Keep track of a batch which was split between the workers
+class BatchTracker:
+    def __init__(self, part_count, resume_token, cluster_time):
+        self.remaining = part_count
+        self.resume_token = resume_token
+        self.cluster_time = cluster_time
+        self.error = None
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self, error=None):
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.set()
+
+
+
+# Flush the parts of the batches given to a worker, with a BigQuery client of its own
+class TransferWorker(threading.Thread):
+    def __init__(self, index):
+        super().__init__(name=f"transfer-worker-{index}", daemon=True)
+        # The queue is bounded, so reading the change stream waits when the worker falls behind
+        self.queue = queue.Queue(maxsize=transfer_worker_queue_size)
+        client = bigquery.Client()
+        self.weather_writer = BigQueryWriter(client, dataset_id, weather_table_id, "hourly_weather_data", partition_column="last_updated")
+        self.tombstone_writer = BigQueryWriter(client, dataset_id, tombstone_table_id, "hourly_weather_data_tombstones")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch, tracker = item
+            try:
+                self.flush(batch)
+                tracker.done()
+            except Exception as e:
+                logging.error(f"{self.name} failed to write a batch of {len(batch)} change event(s) to the dead-letter file. {format_traceback()}.")
+                tracker.done(e)
+
+    def flush(self, batch):
+        # Retry a failed batch with a growing delay, then set it aside so the batches after it are not held up forever
+        for attempt in range(1, transfer_max_attempts + 1):
+            try:
+                with metrics.timer("transfer_flush_seconds"):
+                    flush_batch(batch, self.weather_writer, self.tombstone_writer)
+                return
+            except Exception as e:
+                logging.warning(f"{self.name} failed to flush a batch of {len(batch)} change event(s). Attempt {attempt} of {transfer_max_attempts}. {format_traceback()}.")
+                error = e
+            if attempt < transfer_max_attempts:
+                time.sleep(transfer_retry_delay * 2 ** (attempt - 1))
+        metrics.increment("transfer_failed_batches")
+        write_dead_letters([{"error": str(error), "change": change} for change in batch])
+
+
+
+def get_partition_key(change):
+    # Every change of a document goes to the same worker, so they are applied in order even across batches
+    # Only the id is used, as a delete has no document: the last 8 bytes of the deterministic ids are the hash of the place, so a place stays on one worker too
+    document_id = change["documentKey"]["_id"]
+    if isinstance(document_id, ObjectId):
+        return document_id.binary[4:]
+    return str(document_id).encode()
+
+
+
+def dispatch_batch(batch, workers, in_flight):
+    parts = {}
+    for change in batch:
+        index = zlib.crc32(get_partition_key(change)) % len(workers)
+        parts.setdefault(index, []).append(change)
+    metrics.observe("transfer_batch_size", len(batch))
+    tracker = BatchTracker(len(parts), batch[-1]["_id"], batch[-1]["clusterTime"].as_datetime())
+    in_flight.append(tracker)
+    for index, part in parts.items():
+        workers[index].queue.put((part, tracker))
+
+
+
+def commit_finished_batches(in_flight, wait=False):
+    # Commit the resume tokens in the order of the batches, stopping at the first batch which is not finished
+    while len(in_flight) != 0:
+        tracker = in_flight[0]
+        if wait:
+            tracker.finished.wait()
+        elif not tracker.finished.is_set():
+            return
+        in_flight.popleft()
+        if tracker.error is not None:
+            # The batches after a failed one are finished first, but not committed
+            for later_tracker in in_flight:
+                later_tracker.finished.wait()
+            in_flight.clear()
+            raise tracker.error
+        commit_resume_token(tracker.resume_token, tracker.cluster_time)
+
+
+
+def request_stop(signal_number, frame):
+    global stop_requested
+    logging.info(f"Received signal {signal_number}. Stopping after the buffered changes are flushed")
+    stop_requested = True
+
+
+
+def watch_changes(workers):
+    batch = []
+    batch_started_at = None
+    in_flight = deque()
+    try:
+        with open_stream() as stream:
+            logging.info("Watching for changes...")
+            while stream.alive and not stop_requested:
+                change = stream.try_next()
+                if change is not None:
+                    operation_type = change["operationType"]
+                    # How long after the change happened it is read from the stream
+                    metrics.increment("change_stream_events", operation=operation_type)
+                    metrics.observe("change_stream_lag_seconds", time.time() - change["clusterTime"].time)
+                    coll_id = "'" + change["ns"]["db"] + "." + change["ns"].get("coll", "") + "'"
+                    if operation_type == "insert":
+                        logging.info(f"Document '{str(change['fullDocument']['_id'])}' was INSERTED into {coll_id}")
+                    elif operation_type in ["update", "replace"]:
+                        logging.info(f"Document '{str(change['documentKey']['_id'])}' was UPDATED in {coll_id}")
+                    elif operation_type == "delete":
+                        logging.info(f"Document '{str(change['documentKey']['_id'])}' was DELETED from {coll_id}")
+                    elif operation_type in ["drop", "rename", "dropDatabase", "invalidate"]:
+                        # Flush what has been buffered so far, then reopen the stream after this event
+                        if len(batch) != 0:
+                            dispatch_batch(batch, workers, in_flight)
+                        commit_finished_batches(in_flight, wait=True)
+                        commit_resume_token(change["_id"], change["clusterTime"].as_datetime())
+                        logging.warning(f"The collection was changed (operationType:{operation_type}). Reopening the change stream")
+                        return
+                    else:
+                        # Flush what has been buffered so far before stopping
+                        if len(batch) != 0:
+                            dispatch_batch(batch, workers, in_flight)
+                        commit_finished_batches(in_flight, wait=True)
+                        unexpected_operation_message = f"An unexpected operation was performed (operationType:{operation_type}). Change details: {change}"
+                        logging.error(unexpected_operation_message)
+                        os._exit(1)
+                    if len(batch) == 0:
+                        batch_started_at = time.monotonic()
+                    batch.append(change)
+                # Hand the batch to the workers when it is full or its oldest event has waited long enough
+                if len(batch) != 0 and (len(batch) >= batch_size or time.monotonic() - batch_started_at >= batch_max_delay):
+                    dispatch_batch(batch, workers, in_flight)
+                    batch = []
+                # Only move the resume point forward after the batches have landed
+                commit_finished_batches(in_flight)
+                # Apply the recorded deletes periodically
+                if propagate_deletes and len(pending_tombstone_ids) != 0 and time.monotonic() - tombstones_compacted_at >= tombstone_compaction_interval:
+                    compact_tombstones()
+            # Flush what has been buffered when stopping
+            if len(batch) != 0:
+                dispatch_batch(batch, workers, in_flight)
+    finally:
+        # Drain the batches in flight before leaving, so the saved resume point is as recent as possible
+        commit_finished_batches(in_flight, wait=True)
+
+
+
+if __name__ == "__main__":
+    load_place_ids()
+    if place_registry is not None:
+        place_registry.load(os.path.join(script_dir, "../data"))
+    load_resume_token()
+    if propagate_deletes:
+        load_retention()
+        compact_tombstones()
+    metrics.get_exporter()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    workers = [TransferWorker(index) for index in range(transfer_worker_count)]
+    for worker in workers:
+        worker.start()
+    while not stop_requested:
+        try:
+            watch_changes(workers)
+        except Exception as e:
+            # Reopen the stream from the last committed event, so nothing buffered in the failed batch is lost
+            logging.warning(f"The change stream was interrupted. Resuming after the last committed batch. {format_traceback()}.")
+            time.sleep(5)
+    # Stop the workers once everything has been flushed and committed
+    for worker in workers:
+        worker.queue.put(None)
+    for worker in workers:
+        worker.join()
+    logging.info("Stopped watching for changes")
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import pymongo
+import boto3
+import os
+import json
+import codecs
+import traceback
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ingest_weather_data import get_document_id, to_stored_document, create_indexes
+
+
+
+def list_failed_inserts(s3_client, bucket_name):
+    # List the failed_inserts_*.json files saved by ingest_weather_data.save_to_s3
+    paginator = s3_client.get_paginator("list_objects_v2")
+    file_names = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix="failed_inserts_"):
+        file_names.extend(item["Key"] for item in page.get("Contents", []))
+    return sorted(file_names)
+
+
+
+def iter_documents(body, read_size=65536):
+    # Parse the {"0": {...}, "1": {...}} file one document at a time instead of loading the whole file
+    decoder = json.JSONDecoder()
+    # Decode incrementally so a character split between two reads is not broken
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+    while not finished:
+        raw_chunk = body.read(read_size)
+        chunk = text_decoder.decode(raw_chunk, final=len(raw_chunk) == 0)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            # Skip the whitespace, the opening brace and the separators between the items
+            while position < len(buffer) and buffer[position] in " \t\r\n,:":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "{":
+                    raise ValueError("A failed inserts file must contain a JSON object")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "}":
+                finished = True
+                break
+            # Decode the key and the document, and wait for more data if the document is not complete yet
+            try:
+                _, key_end = decoder.raw_decode(buffer, position)
+                value_start = key_end
+                while value_start < len(buffer) and buffer[value_start] in " \t\r\n:":
+                    value_start += 1
+                document, value_end = decoder.raw_decode(buffer, value_start)
+            except json.JSONDecodeError:
+                break
+            position = value_end
+            yield document
+        if len(raw_chunk) == 0 and not finished:
+            raise ValueError("The failed inserts file ended before it was complete")
+
+
+
+def upsert_documents(collection, documents):
+    # Use the same deterministic ids as the Lambda function, so documents which were inserted before are left as they are
+    if len(documents) == 0:
+        return 0
+    operations = [pymongo.UpdateOne({"_id": get_document_id(document)}, {"$setOnInsert": to_stored_document(document)}, upsert=True) for document in documents]
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        return result.upserted_count
+    except pymongo.errors.BulkWriteError as e:
+        # A duplicate key error means the document has already been inserted
+        failed_errors = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+        if len(failed_errors) != 0:
+            raise
+        return e.details["nUpserted"]
+
+
+
+def replay_file(s3_client, bucket_name, collection, file_name, archive_prefix, chunk_size):
+    body = s3_client.get_object(Bucket=bucket_name, Key=file_name)["Body"]
+    inserted_count = 0
+    documents = []
+    for document in iter_documents(body):
+        documents.append(document)
+        if len(documents) >= chunk_size:
+            inserted_count += upsert_documents(collection, documents)
+            documents = []
+    inserted_count += upsert_documents(collection, documents)
+    # Archive the file so it is not replayed again
+    s3_client.copy_object(Bucket=bucket_name, Key=archive_prefix + file_name, CopySource={"Bucket": bucket_name, "Key": file_name})
+    s3_client.delete_object(Bucket=bucket_name, Key=file_name)
+    return inserted_count
+
+
+
+def replay_failed_inserts(s3_client, bucket_name, collection, concurrency=4, archive_prefix="replayed/", chunk_size=500):
+    file_names = list_failed_inserts(s3_client, bucket_name)
+    print(f"Found {len(file_names)} failed inserts file(s) in '{bucket_name}' bucket")
+    replayed_files = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(replay_file, s3_client, bucket_name, collection, file_name, archive_prefix, chunk_size): file_name for file_name in file_names}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                inserted_count = future.result()
+                replayed_files.append(file_name)
+                print(f"Replayed {file_name}: inserted {inserted_count} new document(s)")
+            except Exception as e:
+                print(f"Failed to replay {file_name}. Error message: \"{e}\"\n{traceback.format_exc()}")
+    print(f"Successfully replayed {len(replayed_files)} of {len(file_names)} file(s)")
+    return replayed_files
+
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    s3_client = boto3.Session(
+        aws_access_key_id = os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name = os.getenv("REGION_NAME")).client("s3")
+    client = pymongo.MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    collection = client[os.getenv("MONGO_DB_NAME")][os.getenv("MONGO_WEATHER_COLLECTION_NAME")]
+    create_indexes(collection)
+    replay_failed_inserts(
+        s3_client,
+        os.getenv("BUCKET_NAME"),
+        collection,
+        concurrency=int(os.getenv("REPLAY_CONCURRENCY", 4)),
+        archive_prefix=os.getenv("REPLAY_ARCHIVE_PREFIX", "replayed/"))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import pymongo
+import os
+from dotenv import load_dotenv
+from ingest_weather_data import create_indexes, get_document_id
+
+# The weather collection stays a regular collection rather than a time-series one:
+# time-series collections support neither change streams, which the transfer daemon watches, nor unique indexes, which keep one document per place and hour
+# It gets the equivalent here: slim documents with a date field, an index for range reads by place and time, and a TTL instead of manual deletes
+load_dotenv()
+retention_days = float(os.getenv("MONGO_RETENTION_DAYS", 90))
+migration_batch_size = int(os.getenv("MIGRATION_BATCH_SIZE", 1000))
+ttl_index_name = "last_updated_at_ttl"
+
+
+
+def get_collection():
+    client = pymongo.MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    database = client[os.getenv("MONGO_DB_NAME")]
+    collection_name = os.getenv("MONGO_WEATHER_COLLECTION_NAME")
+    if collection_name not in database.list_collection_names():
+        database.create_collection(collection_name)
+        print(f"Created '{database.name}.{collection_name}' collection")
+    return database[collection_name]
+
+
+
+def migrate_documents(collection):
+    # Slim the documents written before the Lambda function did it itself, a batch of ids at a time
+    # The daemon skips these updates because they change no field which is in BigQuery
+    pipeline = [
+        {"$set": {"last_updated_at": {"$toDate": {"$multiply": ["$current.last_updated_epoch", 1000]}}}},
+        {"$unset": "location"}
+    ]
+    migrated_count = 0
+    while True:
+        ids = [document["_id"] for document in collection.find({"last_updated_at": {"$exists": False}}, {"_id": 1}).limit(migration_batch_size)]
+        if len(ids) == 0:
+            break
+        migrated_count += collection.update_many({"_id": {"$in": ids}}, pipeline).modified_count
+        print(f"Migrated {migrated_count} document(s)")
+    return migrated_count
+
+
+
+def remove_duplicates(collection):
+    # The unique index of place and hour cannot be built while older documents have duplicates
+    # Keep the document with the deterministic id of its place and hour if there is one, else the oldest
+    pipeline = [
+        {"$group": {"_id": {"place_id": "$place_id", "last_updated_epoch": "$current.last_updated_epoch"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    removed_count = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        place_id = group["_id"].get("place_id")
+        last_updated_epoch = group["_id"].get("last_updated_epoch")
+        kept_id = min(group["ids"])
+        if isinstance(place_id, str) and isinstance(last_updated_epoch, int):
+            document_id = get_document_id({"place_id": place_id, "current": {"last_updated_epoch": last_updated_epoch}})
+            if document_id in group["ids"]:
+                kept_id = document_id
+        removed_count += collection.delete_many({"_id": {"$in": [document_id for document_id in group["ids"] if document_id != kept_id]}}).deleted_count
+    return removed_count
+
+
+
+def set_retention(collection):
+    # Documents expire from MongoDB after the retention period, and BigQuery keeps the history
+    indexes = collection.index_information()
+    if retention_days <= 0:
+        if ttl_index_name in indexes:
+            collection.drop_index(ttl_index_name)
+        print("Documents are kept forever")
+        return
+    expire_after_seconds = int(retention_days * 24 * 3600)
+    if ttl_index_name in indexes:
+        collection.database.command("collMod", collection.name, index={"name": ttl_index_name, "expireAfterSeconds": expire_after_seconds})
+    else:
+        collection.create_index([("last_updated_at", pymongo.ASCENDING)], name=ttl_index_name, expireAfterSeconds=expire_after_seconds)
+    print(f"Documents expire {retention_days} day(s) after their reading")
+
+
+
+if __name__ == "__main__":
+    collection = get_collection()
+    migrated_count = migrate_documents(collection)
+    print(f"Successfully migrated {migrated_count} document(s)")
+    removed_count = remove_duplicates(collection)
+    print(f"Removed {removed_count} duplicate document(s)")
+    create_indexes(collection)
+    # Range reads of a place over time, newest first
+    collection.create_index([("place_id", pymongo.ASCENDING), ("last_updated_at", pymongo.DESCENDING)], name="place_id_last_updated_at")
+    set_retention(collection)
+    print(f"Indexes of '{collection.full_name}' collection: {', '.join(collection.index_information())}")
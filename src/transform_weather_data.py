@@ -0,0 +1,39 @@
+import os
+import re
+import logging
+
+
+
+# The CREATE TABLE statements of the BigQuery tables
+script_dir = os.path.dirname(os.path.abspath(__file__))
+create_tables_file_path = os.path.join(script_dir, "create_tables.sql")
+
+
+
+def read_table_schema(table_name):
+    # Get (column, type, required) of every column of a table from create_tables.sql
+    with open(create_tables_file_path, "r") as f:
+        statements = f.read()
+    match = re.search(r"CREATE TABLE [\w.]*\b" + table_name + r"\s*\((.*?)\n\)", statements, re.DOTALL)
+    if match is None:
+        raise ValueError(f"Table '{table_name}' was not found in {create_tables_file_path}")
+    schema = []
+    for line in match.group(1).split("\n"):
+        column = re.match(r"\s*(\w+)\s+(\w+)(\s+NOT NULL)?", line)
+        if column is not None:
+            schema.append((column.group(1), column.group(2), column.group(3) is not None))
+    return schema
+
+
+
+def process_document(document):
+    document["id"] = str(document["_id"])
+    del document["_id"]
+    document.pop("location", None)
+    for key in document["current"]:
+        document[key] = document["current"][key]
+    del document["current"]
+    document["condition"] = document["condition"]["text"]
+    document["is_day"] = bool(document["is_day"])
+    logging.info(f"Processed document '{document['id']}'")
+    return document
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts in src import each other by module name, as they do when they are run from that directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
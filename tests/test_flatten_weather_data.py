@@ -0,0 +1,47 @@
+import copy
+from bson import ObjectId
+from bigquery_writer import BigQueryWriter
+from flatten_weather_data import flatten_documents, weather_schema
+from transform_weather_data import process_document
+
+
+
+def make_document(place_id, last_updated_epoch, last_updated, **current):
+    document = {
+        "_id": ObjectId(),
+        "place_id": place_id,
+        "location": {"name": place_id, "lat": 10.82, "lon": 106.63},
+        "current": {
+            "last_updated_epoch": last_updated_epoch, "last_updated": last_updated,
+            "temp_c": 31.2, "temp_f": 88.2, "is_day": 1,
+            "condition": {"text": "Partly cloudy", "icon": "//cdn.weatherapi.com/weather/64x64/day/116.png", "code": 1003},
+            "wind_mph": 5.6, "wind_kph": 9.0, "wind_degree": 200, "wind_dir": "SSW", "pressure_mb": 1010.0, "pressure_in": 29.83,
+            "precip_mm": 0.12, "precip_in": 0.0, "humidity": 66, "cloud": 50,
+            "feelslike_c": 35.4, "feelslike_f": 95.7, "vis_km": 10.0, "vis_miles": 6.0, "uv": 7.0, "gust_mph": 8.1, "gust_kph": 13.0
+        }
+    }
+    document["current"].update(current)
+    return document
+
+
+
+def test_flatten_documents_matches_process_document():
+    documents = [
+        make_document("hcm", 1704088800, "2024-01-01 13:00"),
+        # Night, integers in float columns and zero values
+        make_document("hanoi", 1704124800, "2024-01-01 23:00", is_day=0, temp_c=18, uv=0, precip_mm=0),
+        # Columns missing from the response are left empty
+        make_document("danang", 1704092400, "2024-01-01 14:00", gust_kph=None, condition={"text": None})
+    ]
+    del documents[2]["current"]["uv"]
+    writer = BigQueryWriter(None, "dataset", "table", "hourly_weather_data")
+    columns = [column for column, _, _ in weather_schema]
+    # The old transform: process_document on each document, then the conversion to the column types of the writer
+    expected_rows = []
+    for document in copy.deepcopy(documents):
+        typed_row = writer.to_typed_row(process_document(document))
+        expected_rows.append({column: typed_row.get(column) for column in columns})
+
+    rows = flatten_documents(documents).to_pylist()
+
+    assert rows == expected_rows
@@ -0,0 +1,43 @@
+import math
+import random
+from datetime import datetime
+from bson import ObjectId
+from place_registry import PlaceRegistry, PlaceSnapshot
+
+
+
+def find_nearest(coordinates, lat, lon):
+    # Compare the point with every place, with the same distance as PlaceSnapshot
+    return min(coordinates, key=lambda place_id: math.hypot(coordinates[place_id]["lat"] - lat, (coordinates[place_id]["lon"] - lon) * math.cos(math.radians(lat))))
+
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(42)
+    # Places spread over Vietnam, with some clustered in one cell and some far apart
+    coordinates = {f"place-{index}": {"lat": round(rng.uniform(8, 23.5), 5), "lon": round(rng.uniform(102, 110), 5)} for index in range(200)}
+    coordinates.update({f"cluster-{index}": {"lat": 10.8 + index * 0.001, "lon": 106.6 + index * 0.001} for index in range(20)})
+    snapshot = PlaceSnapshot(1, coordinates)
+    for _ in range(500):
+        lat, lon = rng.uniform(6, 25), rng.uniform(100, 112)
+        assert snapshot.nearest(lat, lon) == find_nearest(coordinates, lat, lon)
+
+
+
+def test_nearest_without_places():
+    assert PlaceSnapshot(0, {}).nearest(10.0, 106.0) is None
+
+
+
+def test_save_and_load_keep_the_cursor(tmp_path):
+    registry = PlaceRegistry()
+    last_id = ObjectId()
+    registry.snapshot = PlaceSnapshot(3, {"hcm": {"lat": 10.75, "lon": 106.67}}, last_id, datetime(2024, 1, 1, 7, 30))
+    registry.save(str(tmp_path))
+
+    loaded = PlaceRegistry().load(str(tmp_path))
+
+    assert loaded.version == 3
+    assert loaded.coordinates == {"hcm": {"lat": 10.75, "lon": 106.67}}
+    assert loaded.last_id == last_id
+    assert loaded.last_updated_at == datetime(2024, 1, 1, 7, 30)
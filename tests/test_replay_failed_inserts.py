@@ -0,0 +1,62 @@
+import json
+import boto3
+import mongomock
+import pytest
+from moto import mock_aws
+from ingest_weather_data import get_document_id
+from replay_failed_inserts import replay_failed_inserts
+
+bucket_name = "weather-test-bucket"
+file_name = "failed_inserts_20240101070000.json"
+
+
+
+def make_document(place_id, last_updated_epoch):
+    return {
+        "place_id": place_id,
+        "location": {"name": place_id, "lat": 10.0, "lon": 106.0},
+        "current": {"last_updated_epoch": last_updated_epoch, "last_updated": "2024-01-01 07:00", "temp_c": 25.0}
+    }
+
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=bucket_name)
+        yield s3_client
+
+
+
+def test_replay_upserts_by_deterministic_id_and_archives_the_file(s3_client):
+    documents = [make_document("hcm", 1704067200), make_document("hanoi", 1704067200)]
+    # The same format as ingest_weather_data.save_to_s3
+    s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=json.dumps({index: document for index, document in enumerate(documents)}, indent=4))
+    collection = mongomock.MongoClient().db.weather
+    # The first document was inserted before the Lambda function failed, and must be left as it is
+    collection.insert_one({"_id": get_document_id(documents[0]), "place_id": "hcm", "current": {"last_updated_epoch": 1704067200, "temp_c": 30.0}})
+
+    replayed_files = replay_failed_inserts(s3_client, bucket_name, collection, concurrency=1, chunk_size=1)
+
+    assert replayed_files == [file_name]
+    assert collection.count_documents({}) == 2
+    assert collection.find_one({"_id": get_document_id(documents[0])})["current"]["temp_c"] == 30.0
+    inserted_document = collection.find_one({"_id": get_document_id(documents[1])})
+    assert inserted_document["place_id"] == "hanoi"
+    assert inserted_document["current"]["temp_c"] == 25.0
+    assert "location" not in inserted_document
+    keys = [item["Key"] for item in s3_client.list_objects_v2(Bucket=bucket_name)["Contents"]]
+    assert keys == ["replayed/" + file_name]
+
+
+
+def test_replay_twice_inserts_nothing_new(s3_client):
+    document = make_document("hcm", 1704067200)
+    s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=json.dumps({0: document}))
+    collection = mongomock.MongoClient().db.weather
+    replay_failed_inserts(s3_client, bucket_name, collection, concurrency=1)
+    # The same file saved again by a later failure must not create a duplicate
+    s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=json.dumps({0: document}))
+    replay_failed_inserts(s3_client, bucket_name, collection, concurrency=1)
+    assert collection.count_documents({}) == 1
@@ -0,0 +1,188 @@
+import re
+import importlib
+from collections import deque
+from datetime import datetime
+import pytest
+from bson.timestamp import Timestamp
+from google.cloud import bigquery
+import benchmark_pipeline
+from benchmark_pipeline import FakeBigQueryClient, FakeBigQueryJob, benchmark_environment, create_weather_response
+from ingest_weather_data import get_document_id
+
+place_ids = ["hcm", "hanoi"]
+
+
+
+# The fake client of the benchmark, keeping the rows of the weather and tombstone tables in memory
+class InMemoryBigQueryClient(FakeBigQueryClient):
+    place_ids = place_ids
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tables = {}
+        self.summary_failures = 0
+
+    def get_rows(self, table):
+        return self.tables.setdefault(table, {})
+
+    def query(self, query, job_config=None):
+        if "_daily" in query and query.strip().startswith("MERGE") and self.summary_failures > 0:
+            self.summary_failures -= 1
+            raise RuntimeError("Could not serialize access to the table due to concurrent update")
+        job = super().query(query, job_config)
+        weather_rows = self.get_rows("benchmark.hourly_weather_data")
+        if "SELECT DISTINCT id" in query:
+            values = [parameter for parameter in job_config.query_parameters if parameter.name == "values"][0].values
+            return FakeBigQueryJob(rows=[{"id": value} for value in values if value in weather_rows])
+        if query.strip().startswith("MERGE `benchmark.hourly_weather_data`"):
+            staging_table = re.search(r"USING `([^`]+)`", query).group(1)
+            for row in self.tables.pop(staging_table, {}).values():
+                weather_rows[row["id"]] = row
+        if "CREATE TEMP TABLE compacted_tombstones" in query:
+            tombstone_rows = self.get_rows("benchmark.hourly_weather_data_tombstones")
+            for document_id in tombstone_rows:
+                weather_rows.pop(document_id, None)
+            tombstone_rows.clear()
+        return job
+
+    def load_table_from_json(self, rows, table, job_config=None):
+        rows = list(rows)
+        self.get_rows(str(table)).update((row["id"], row) for row in rows)
+        return super().load_table_from_json(rows, table, job_config)
+
+
+
+@pytest.fixture(scope="module")
+def daemon(tmp_path_factory):
+    # The daemon reads its configuration when it is imported, and writes its log to ../log
+    work_dir = tmp_path_factory.mktemp("daemon")
+    (work_dir / "log").mkdir()
+    (work_dir / "work").mkdir()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for key, value in benchmark_environment.items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.delenv("MONGO_PLACES_COLLECTION_NAME", raising=False)
+        monkeypatch.setenv("RESUME_TOKEN_FILE", str(work_dir / "resume_token.json"))
+        monkeypatch.setattr(bigquery, "Client", InMemoryBigQueryClient)
+        monkeypatch.chdir(work_dir / "work")
+        yield importlib.import_module("process_insert_update_weather_data")
+
+
+
+@pytest.fixture
+def client(daemon, monkeypatch, tmp_path):
+    # One client for the daemon and its workers, with deletes propagated and no waiting between retries
+    client = InMemoryBigQueryClient()
+    monkeypatch.setattr(benchmark_pipeline, "bigquery_latency", 0)
+    monkeypatch.setattr(bigquery, "Client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(daemon, "bigquery_client", client)
+    monkeypatch.setattr(daemon, "place_ids_loaded_at", None)
+    monkeypatch.setattr(daemon, "propagate_deletes", True)
+    monkeypatch.setattr(daemon, "transfer_retry_delay", 0)
+    monkeypatch.setattr(daemon, "dead_letter_file_path", str(tmp_path / "dead_letters.jsonl"))
+    daemon.pending_tombstone_ids.clear()
+    return client
+
+
+
+def get_writers(daemon, client):
+    weather_writer = daemon.BigQueryWriter(client, "benchmark", "hourly_weather_data", "hourly_weather_data", partition_column="last_updated")
+    tombstone_writer = daemon.BigQueryWriter(client, "benchmark", "hourly_weather_data_tombstones", "hourly_weather_data_tombstones")
+    return weather_writer, tombstone_writer
+
+
+
+def make_document(place_id, temp_c=25.0):
+    document = create_weather_response("10.75,106.67", datetime(2024, 1, 1, 7))
+    document["place_id"] = place_id
+    document["current"]["temp_c"] = temp_c
+    document["_id"] = get_document_id(document)
+    del document["location"]
+    return document
+
+
+
+def make_change(operation_type, document, index=1):
+    change = {"_id": {"_data": f"{index:016x}"}, "operationType": operation_type, "clusterTime": Timestamp(1704092400, index), "documentKey": {"_id": document["_id"]}}
+    if operation_type != "delete":
+        change["fullDocument"] = document
+    return change
+
+
+
+def test_insert_then_delete_in_one_batch_is_only_tombstoned(daemon, client):
+    document = make_document("hcm")
+    daemon.flush_batch([make_change("insert", document, 1), make_change("delete", document, 2)], *get_writers(daemon, client))
+
+    assert client.get_rows("benchmark.hourly_weather_data") == {}
+    assert list(client.get_rows("benchmark.hourly_weather_data_tombstones")) == [str(document["_id"])]
+
+
+
+def test_delete_then_insert_in_one_batch_merges_the_new_version(daemon, client):
+    weather_writer, tombstone_writer = get_writers(daemon, client)
+    document = make_document("hcm", temp_c=25.0)
+    daemon.flush_batch([make_change("insert", document, 1)], weather_writer, tombstone_writer)
+    document = make_document("hcm", temp_c=30.0)
+
+    daemon.flush_batch([make_change("delete", document, 2), make_change("insert", document, 3)], weather_writer, tombstone_writer)
+
+    assert client.get_rows("benchmark.hourly_weather_data")[str(document["_id"])]["temp_c"] == 30.0
+    assert client.get_rows("benchmark.hourly_weather_data_tombstones") == {}
+    assert str(document["_id"]) not in daemon.pending_tombstone_ids
+
+
+
+def test_retry_recomputes_the_summary_of_rows_loaded_by_a_failed_attempt(daemon, client):
+    client.summary_failures = 1
+    worker = daemon.TransferWorker(0)
+    document = make_document("hcm")
+
+    worker.flush([make_change("insert", document, 1)])
+
+    assert list(client.get_rows("benchmark.hourly_weather_data")) == [str(document["_id"])]
+    assert sum(job.startswith("LOAD benchmark.hourly_weather_data") and "tombstones" not in job for job in client.jobs) == 1
+    assert sum("_daily" in job for job in client.jobs) == 1
+
+
+
+def test_batch_which_keeps_failing_is_dead_lettered(daemon, client):
+    client.summary_failures = daemon.transfer_max_attempts
+    worker = daemon.TransferWorker(0)
+    document = make_document("hcm")
+
+    worker.flush([make_change("insert", document, 1)])
+
+    with open(daemon.dead_letter_file_path, "r") as f:
+        assert len(f.readlines()) == 1
+
+
+
+def test_every_change_of_a_document_has_the_same_partition_key(daemon):
+    document = make_document("hcm")
+    keys = {daemon.get_partition_key(make_change(operation_type, document)) for operation_type in ["insert", "update", "delete"]}
+    assert len(keys) == 1
+
+
+
+def test_delete_then_insert_in_the_next_batch_keeps_the_row(daemon, client):
+    workers = [daemon.TransferWorker(index) for index in range(4)]
+    for worker in workers:
+        worker.start()
+    in_flight = deque()
+    weather_writer, tombstone_writer = get_writers(daemon, client)
+    document = make_document("hcm", temp_c=25.0)
+    daemon.flush_batch([make_change("insert", document, 1)], weather_writer, tombstone_writer)
+    document = make_document("hcm", temp_c=30.0)
+
+    # The other place of each batch is handled by another worker
+    daemon.dispatch_batch([make_change("delete", document, 2), make_change("insert", make_document("hanoi"), 3)], workers, in_flight)
+    daemon.dispatch_batch([make_change("insert", document, 4), make_change("delete", make_document("hanoi"), 5)], workers, in_flight)
+    daemon.commit_finished_batches(in_flight, wait=True)
+    daemon.compact_tombstones()
+    for worker in workers:
+        worker.queue.put(None)
+
+    weather_rows = client.get_rows("benchmark.hourly_weather_data")
+    assert list(weather_rows) == [str(document["_id"])]
+    assert weather_rows[str(document["_id"])]["temp_c"] == 30.0